@@ -138,7 +138,7 @@ if __name__ == "__main__":
 
     xml = XMLData(dataset / "raw/xml")
     xml.fix_segments(dataset / "raw/wav")
-    correct_item = patch_item(read_item(args.test_item), xml.segments)
+    correct_item = patch_item(read_item(args.test_item, cache=False), xml.segments)
     test_speakers = set(correct_item.speaker_id)
     xml_train_segments = xml.segments[~xml.segments.speaker_id.isin(test_speakers)]
     test_segments = patch_test_segments(pd.read_csv(args.segments_txt, sep=" ", header=None), xml.segments)
@@ -6,9 +6,10 @@ from typing import Literal
 import pandas as pd
 
 from plearning.phone_pair import PhonePair
-from plearning.utils import query
+from plearning.warehouse import Warehouse
 
 ROOT = Path("./abx/")
+SETUPS = {"baseline": "no_pretraining", "crossling": "crossling_pretraining", "noise": "noise_pretraining"}
 
 
 def get_jap(mean: pd.DataFrame, std: pd.DataFrame, score_col: str) -> str:
@@ -28,37 +29,23 @@ def get_english(mean: pd.DataFrame, std: pd.DataFrame, score_col: str) -> str:
 
 
 def main(mode: Literal["within", "across"], phone_pair: PhonePair) -> pd.DataFrame:
-    no_pretraining = pd.read_csv(ROOT / "no_pretraining.csv")
-    noise_pretrained = pd.read_csv(ROOT / "noise_pretraining.csv")
-    crossling = pd.read_csv(ROOT / "crossling_pretraining.csv")
-    scores = no_pretraining.merge(
-        crossling,
-        on=["test", "train", "phone_pair", "split", "idx", "mode"],
-        suffixes=["", "_crossling"],
-        how="outer",
-    ).merge(
-        noise_pretrained,
-        on=["test", "train", "phone_pair", "split", "idx", "mode"],
-        suffixes=["_baseline", "_noise"],
-        how="outer",
-    )
-    scores = scores[query(scores, mode=mode, phone_pair=phone_pair)]
-    lang_available = scores.test.unique()
-
-    mean = scores.groupby(["test", "train", "split"], as_index=False)[
-        ["score_baseline", "score_crossling", "score_noise"]
-    ].mean()
-    std = scores.groupby(["test", "train", "split"], as_index=False)[
-        ["score_baseline", "score_crossling", "score_noise"]
-    ].std(ddof=0)
+    with Warehouse(ROOT / "scores.db") as warehouse:
+        for setup, name in SETUPS.items():
+            warehouse.import_table(ROOT / f"{name}.csv", setup)
+        stats = warehouse.stats(mode, phone_pair, list(SETUPS))
+    stats = stats.pivot(index=["test", "train", "split"], columns="setup", values=["mean", "std"])
+    mean = stats["mean"].add_prefix("score_").reset_index()
+    std = stats["std"].add_prefix("score_").reset_index()
+    lang_available = mean.test.unique()
 
+    stds = dict(list(std.groupby(["train", "split"])))
     table = defaultdict(list)
     for col, setup in zip(
         ["score_baseline", "score_crossling", "score_noise"],
         ["No pretraining", "Cross-lingual", "Ambient sounds"],
     ):
         for (train, split), submean in mean.groupby(["train", "split"]):
-            substd = std[query(std, train=train, split=split)]
+            substd = stds[(train, split)]
             assert len(substd) == len(submean)
             table["Pretraining"].append(setup)
             table["Training"].append(f"{train} {500//split}h")
@@ -28,7 +28,8 @@ export CMD="python $WORK/CPC3/cpc/train.py \
 	--nEpoch $3 \
 	--augment_past \
 	--augment_type pitch artificial_reverb \
-	--samplingType samespeaker"
+	--samplingType samespeaker \
+	${4:+--pathTrain $4}"
 
 echo $CMD
 srun $CMD
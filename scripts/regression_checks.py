@@ -0,0 +1,365 @@
+"""Regression checks of the vectorized computations against brute-force or baseline references, on synthetic data"""
+import argparse
+import contextlib
+import io
+import itertools
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+import pandas as pd
+
+from plearning.abx import abx_across, abx_within, dtw_distances
+from plearning.tokens import Tokens
+
+CHECKS: dict[str, Callable[[np.random.Generator], None]] = {}
+
+
+def check(name: str) -> Callable[[Callable[[np.random.Generator], None]], Callable[[np.random.Generator], None]]:
+    def register(function: Callable[[np.random.Generator], None]) -> Callable[[np.random.Generator], None]:
+        CHECKS[name] = function
+        return function
+
+    return register
+
+
+def synthetic_tokens(rng: np.random.Generator, speakers: int = 3, contexts: int = 2, phones: int = 3) -> Tokens:
+    """Tokens of random lengths with random unit frames, with between zero and two tokens per cell"""
+    labels = [
+        (speaker, context, phone)
+        for speaker, context, phone in itertools.product(range(speakers), range(contexts), range(phones))
+        for _ in range(rng.integers(0, 3))
+    ]
+    speaker, context, phone = (np.array(column, dtype=np.int64) for column in zip(*labels))
+    lengths = rng.integers(1, 7, size=len(labels))
+    frames = rng.normal(size=(lengths.sum(), 4))
+    frames /= np.linalg.norm(frames, axis=1, keepdims=True)
+    return Tokens(
+        frames=frames.astype(np.float32),
+        offsets=np.concatenate([[0], np.cumsum(lengths)[:-1]]),
+        lengths=lengths,
+        phone=phone,
+        context=context,
+        speaker=speaker,
+        phone_match={f"p{i}": i for i in range(phones)},
+        context_match={f"c{i}": i for i in range(contexts)},
+        speaker_match={f"s{i}": i for i in range(speakers)},
+        rows=np.arange(len(labels)),
+    )
+
+
+def reference_dtw(x: np.ndarray, y: np.ndarray) -> float:
+    """DTW of CPC3 on the angular distances of two tokens, cell by cell, normalized by the length of the path
+
+    The distances are computed in float32 as in CPC3: the arccos of a dot product close to 1 is ill-conditioned.
+    """
+    dist = np.arccos(np.clip(x @ y.T, -1, 1)).astype(np.float64) / np.pi
+    n, m = dist.shape
+    cost, length = np.full((n + 1, m + 1), np.inf), np.zeros((n + 1, m + 1), dtype=int)
+    cost[0, 0] = 0
+    for i, j in itertools.product(range(n), range(m)):
+        previous = min([(i, j), (i, j + 1), (i + 1, j)], key=lambda cell: cost[cell])
+        cost[i + 1, j + 1] = dist[i, j] + cost[previous]
+        length[i + 1, j + 1] = length[previous] + 1
+    return float(cost[n, m] / length[n, m])
+
+
+def reference_abx(tokens: Tokens, across: bool) -> tuple[np.ndarray, np.ndarray]:
+    """Sum and count of the ABX errors, enumerating every (x, a, b) triplet of every cell"""
+    frames = [tokens.frames[start : start + length] for start, length in zip(tokens.offsets, tokens.lengths)]
+    distances: dict[tuple[int, int], float] = {}
+
+    def distance(first: int, second: int) -> float:
+        if first == second:
+            return 0.0
+        key = (min(first, second), max(first, second))
+        if key not in distances:
+            distances[key] = reference_dtw(frames[key[0]], frames[key[1]])
+        return distances[key]
+
+    cells = defaultdict(list)
+    for token, (context, speaker, phone) in enumerate(zip(tokens.context, tokens.speaker, tokens.phone)):
+        cells[(context, speaker, phone)].append(token)
+    shape = (tokens.speaker.max() + 1, len(tokens.phone_match), len(tokens.phone_match))
+    sums, counts = np.zeros(shape), np.zeros(shape)
+    for (context, speaker, phone_a), a in cells.items():
+        for phone_b in range(shape[1]):
+            b = cells.get((context, speaker, phone_b), [])
+            if phone_b == phone_a or not b:
+                continue
+            if across:
+                xs = [cells.get((context, other, phone_a), []) for other in range(shape[0]) if other != speaker]
+            else:
+                xs = [a] if len(a) > 1 else []
+            for x in filter(None, xs):
+                scores = [
+                    float(distance(x_, a_) < distance(x_, b_)) + 0.5 * float(distance(x_, a_) == distance(x_, b_))
+                    for x_, a_, b_ in itertools.product(x, a, b)
+                    if across or x_ != a_
+                ]
+                sums[speaker, phone_a, phone_b] += 1 - np.mean(scores)
+                counts[speaker, phone_a, phone_b] += 1
+    return sums, counts
+
+
+@check("abx")
+def check_abx(rng: np.random.Generator) -> None:
+    """DTW distances and within and across speaker ABX errors against a brute-force enumeration (user-001)"""
+    tokens = synthetic_tokens(rng)
+    first, second = (pairs.ravel() for pairs in np.meshgrid(np.arange(len(tokens)), np.arange(len(tokens))))
+    frames = [tokens.frames[start : start + length] for start, length in zip(tokens.offsets, tokens.lengths)]
+    expected = [reference_dtw(frames[i], frames[j]) for i, j in zip(first, second)]
+    # A float32 dot product one ulp below 1 already has an arccos of 1e-4 pi, so the summation order shows there
+    np.testing.assert_allclose(dtw_distances(tokens, first, second), expected, atol=2e-4, err_msg="DTW distances")
+
+    # Groups larger than any cell, so that neither function subsamples
+    for name, (sums, counts) in {
+        "within": abx_within(tokens, 100, rng),
+        "across": abx_across(tokens, 100, 100, rng),
+    }.items():
+        expected_sums, expected_counts = reference_abx(tokens, across=name == "across")
+        np.testing.assert_array_equal(counts, expected_counts, err_msg=f"ABX {name} counts")
+        np.testing.assert_allclose(sums, expected_sums, atol=1e-9, err_msg=f"ABX {name} errors")
+
+
+@check("mfcc")
+def check_mfcc(rng: np.random.Generator) -> None:
+    """Batched MFCC of files of different lengths against the MFCC of each file on its own (user-002)"""
+    import torch
+    import torchaudio
+
+    from plearning.mfcc import batched_mfcc
+
+    mfcc = torchaudio.transforms.MFCC(n_mfcc=39, melkwargs={"n_fft": 321})
+    waveforms = [torch.from_numpy(rng.normal(size=(1, length)).astype(np.float32)) for length in [161, 4000, 4093]]
+    waveforms.append(torch.zeros(1, 2000))  # Silence, where the top_db threshold of the whole batch would differ
+    for x, batched in zip(waveforms, batched_mfcc(mfcc, waveforms)):
+        expected = mfcc(x).permute(0, 2, 1)
+        assert batched.shape == expected.shape, f"Shape {tuple(batched.shape)} instead of {tuple(expected.shape)}"
+        np.testing.assert_allclose(batched.numpy(), expected.numpy(), atol=1e-5, err_msg="MFCC")
+
+
+def baseline_greedy_split(all_segments: list[pd.DataFrame], split: int, groupby_key: str) -> list[pd.DataFrame]:
+    """`greedy_split` of the baseline, splitting each partition of the previous level in turn"""
+    result = []
+    for segments in all_segments:
+        indices: list[list[int]] = [[] for _ in range(split)]
+        durations = np.zeros(split)
+        duration_by_key = segments.groupby(groupby_key)["duration"].sum()
+        for idx, duration in duration_by_key.items():
+            min_idx = np.argmin(durations)
+            indices[min_idx].append(idx)
+            durations[min_idx] += duration
+        for idx in indices:
+            current_keys = duration_by_key.loc[idx].index
+            result.append(segments[segments[groupby_key].isin(current_keys)])
+    return result
+
+
+@check("partition")
+def check_partition(rng: np.random.Generator) -> None:
+    """Partitions written by `create_partitions` at every level against the baseline greedy split (user-007)"""
+    from plearning.data.partition import create_partitions
+    from plearning.keys import GroupbyKey
+
+    size, split_factors = 400, [3, 2, 4]
+    start = rng.uniform(0, 100, size).round(2)
+    segments = pd.DataFrame(
+        {
+            "seg_id": [f"seg{i:03d}" for i in range(size)],
+            "talk_id": [f"talk{i:02d}" for i in rng.integers(0, 60, size)],
+            "speaker_id": [f"spk{i}" for i in rng.integers(0, 30, size)],
+            "start": start,
+            "end": start + rng.uniform(0.5, 20, size).round(2),
+        }
+    )
+    for groupby_key in GroupbyKey:
+        with tempfile.TemporaryDirectory() as directory:
+            root = Path(directory)
+            (root / "full").mkdir()
+            segments.to_csv(root / "segments.csv", index=False)
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):  # Progress
+                create_partitions(root / "full", root / "segments.csv", groupby_key, False, 7, split_factors)
+            written = [pd.read_csv(root / groupby_key / f"{split}.csv") for split in np.cumprod(split_factors)]
+            # Read back as the baseline did: durations with two decimals tie, so the parsed values matter
+            shuffled = pd.read_csv(root / "segments.csv")
+
+        shuffled = shuffled.assign(duration=shuffled["end"] - shuffled["start"]).sample(frac=1, random_state=7)
+        partitions = [shuffled]
+        for split_factor, level in zip(split_factors, written):
+            partitions = baseline_greedy_split(partitions, split_factor, groupby_key)
+            expected = pd.concat([partition.assign(split_id=idx) for idx, partition in enumerate(partitions)])
+            pd.testing.assert_frame_equal(
+                level[["seg_id", "split_id"]],
+                expected[["seg_id", "split_id"]].reset_index(drop=True),
+                obj=f"Partitions by {groupby_key} in {len(partitions)}",
+            )
+
+
+def reference_rows(scores: pd.DataFrame, selection: dict[str, object]) -> np.ndarray:
+    """Rows of the scores whose dimensions take the selected values, with a boolean mask per dimension"""
+    mask = np.ones(len(scores), dtype=bool)
+    for dimension, value in selection.items():
+        values = value if isinstance(value, list) else [value]
+        matches = scores[dimension].isin([single for single in values if single is not None])
+        if None in values:
+            matches |= scores[dimension].isna()
+        mask &= matches.to_numpy()
+    return np.flatnonzero(mask)
+
+
+@check("cube")
+def check_cube(rng: np.random.Generator) -> None:
+    """Selections of the score cube, by ranges and by masks, against a boolean mask per dimension (user-023)"""
+    from plearning import cube
+
+    size = 5000
+    values: dict[str, list[Any]] = {
+        "mode": ["within", "across"],
+        "test": ["csj", "gpj", "buc", "wsj"],
+        "train": ["English", "Japanese"],
+        "split": [1.0, 5.0, 25.0, np.nan],
+        "phone_pair": ["[a]-[e]", "[a]-[i]", "[e]-[i]", "[k]-[g]", "[s]-[z]", np.nan],
+        "idx": [0, 1, 2, 3, 4],
+        "epoch": list(range(10)),
+    }
+    scores = pd.DataFrame(
+        {name: rng.choice(np.array(choices, dtype=object), size) for name, choices in values.items()}
+    )
+    scores = scores.astype({"split": float, "idx": int, "epoch": int}).assign(score=rng.uniform(size=size))
+    scores["row"] = np.arange(size)
+    score_cube = cube.ScoreCube(scores)
+
+    default_fraction = cube.MAX_RANGES_FRACTION
+    for _ in range(200):
+        selection: dict[str, object] = {}
+        for name in rng.choice(list(values), size=rng.integers(1, 5), replace=False):
+            present = [None if pd.isna(value) else value for value in values[name]]
+            count = rng.integers(1, min(4, len(present) + 1))
+            chosen = [present[i] for i in rng.choice(len(present), size=count, replace=False)]
+            selection[name] = chosen if len(chosen) > 1 or rng.random() < 0.5 else chosen[0]
+        expected = reference_rows(scores, selection)
+        for fraction in [0, np.inf]:  # Always by masks, then always by ranges
+            cube.MAX_RANGES_FRACTION = fraction
+            rows = score_cube.rows(**selection)
+            assert np.all(np.diff(rows) > 0), f"Unsorted rows for {selection}"
+            selected = np.sort(score_cube.frame["row"].to_numpy()[rows])
+            np.testing.assert_array_equal(selected, expected, err_msg=f"Rows of {selection}")
+    cube.MAX_RANGES_FRACTION = default_fraction
+
+    languages = {"English": "English", "Japanese": "Japanese", "csj": "Japanese", "gpj": "Japanese", "buc": "English"}
+    native, nonnative = score_cube.native_nonnative(["csj", "buc", "wsj"], languages, mode="within")
+    rows = reference_rows(scores, {"mode": "within", "test": ["csj", "buc", "wsj"]})
+    is_native = scores["test"].map(languages).iloc[rows].to_numpy() == scores["train"].iloc[rows].to_numpy()
+    np.testing.assert_array_equal(np.sort(native["row"]), rows[is_native], err_msg="Native scores")
+    np.testing.assert_array_equal(np.sort(nonnative["row"]), rows[~is_native], err_msg="Non-native scores")
+
+
+def reference_adjust(p_values: np.ndarray) -> np.ndarray:
+    """Benjamini-Hochberg adjusted p-values by their definition: min over larger p-values of p * m / rank, at most 1"""
+    tested = p_values[~np.isnan(p_values)]
+    ranks = np.array([(tested <= p).sum() for p in tested])
+    adjusted = np.full(len(p_values), np.nan)
+    adjusted[~np.isnan(p_values)] = [
+        min(1, min(q * len(tested) / rank for q, rank in zip(tested, ranks) if q >= p)) for p in tested
+    ]
+    return adjusted
+
+
+@check("significance")
+def check_significance(rng: np.random.Generator) -> None:
+    """Means, bootstrap intervals, permutation p-values and the BH correction against per-condition loops (user-025)"""
+    from plearning.significance import adjust_p_values, compare_native_nonnative
+
+    p_values = rng.uniform(size=50) ** 3
+    p_values[rng.choice(50, 5, replace=False)] = np.nan
+    p_values[:10] = p_values[10]  # Ties
+    np.testing.assert_allclose(adjust_p_values(p_values), reference_adjust(p_values), err_msg="BH adjusted p-values")
+
+    counts = [(3, 4), (4, 4), (3, 4), (2, 5), (1, 1), (6, 0), (8, 8)]
+    models = pd.DataFrame(
+        [
+            {
+                "phone_pair": f"pair{i}",
+                "split": 5,
+                "native": native,
+                "idx": idx,
+                "score": rng.normal(0.2 * native, 0.1),
+            }
+            for i, count in enumerate(counts)
+            for native, size in zip([True, False], count)
+            for idx in range(size)
+        ]
+    )
+    n_bootstrap, n_permutations, quantiles = 300, 1000, [0.025, 0.975]
+    tables = [
+        compare_native_nonnative(models, n_bootstrap, n_permutations, 0.95, 3, memory, n_jobs)
+        for memory, n_jobs in [(512, 1), (0, 2)]
+    ]
+    pd.testing.assert_frame_equal(tables[0], tables[1], obj="Statistics with other chunks and jobs")
+    np.testing.assert_allclose(
+        tables[0]["p_adjusted"], reference_adjust(tables[0]["p_value"].to_numpy()), err_msg="BH of the conditions"
+    )
+
+    table = tables[0].set_index("phone_pair")
+    for i, (native, nonnative) in enumerate(counts):
+        condition = models[models["phone_pair"] == f"pair{i}"]
+        values = [condition.loc[condition["native"] == side, "score"].to_numpy() for side in [True, False]]
+        row = table.loc[f"pair{i}"]
+        if native == 0 or nonnative == 0:
+            assert np.isnan(row["p_value"]), f"p-value of pair{i}, without models on one side"
+            continue
+        condition_rng = np.random.default_rng([3, native, nonnative])
+        boots = [
+            values[side][condition_rng.integers(0, len(values[side]), (n_bootstrap, len(values[side])))].mean(axis=1)
+            for side in [0, 1]
+        ]
+        for name, boot in zip(["native", "nonnative", "difference"], [boots[0], boots[1], boots[1] - boots[0]]):
+            np.testing.assert_allclose(
+                row[[f"{name}_low", f"{name}_high"]].to_numpy(dtype=float),
+                np.quantile(boot, quantiles),
+                err_msg=f"{name} interval of pair{i}",
+            )
+        np.testing.assert_allclose(
+            row[["native", "nonnative"]].to_numpy(dtype=float), [value.mean() for value in values]
+        )
+
+        pooled, observed = np.concatenate(values), values[1].mean() - values[0].mean()
+        differences = [
+            pooled[list(group)].mean() - np.delete(pooled, list(group)).mean()
+            for group in itertools.combinations(range(native + nonnative), nonnative)
+        ]
+        exact = np.mean(np.abs(differences) >= abs(observed) - 1e-12)
+        # Relabellings are enumerated up to n_permutations of them, and drawn at random beyond
+        tolerance = 1e-12 if len(differences) <= n_permutations else 0.05
+        assert abs(row["p_value"] - exact) <= tolerance, f"p-value of pair{i}: {row['p_value']} instead of {exact}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "checks", nargs="*", choices=[[], *CHECKS], metavar="CHECK", help=f"Checks to run among {', '.join(CHECKS)}"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    args = parser.parse_args()
+
+    failures = []
+    for name in args.checks or CHECKS:
+        start = time.perf_counter()
+        try:
+            CHECKS[name](np.random.default_rng(args.seed))
+        except AssertionError as error:
+            failures.append(f"{name}: {error}")
+            print(f"{name:<14} FAILED")
+        else:
+            print(f"{name:<14} ok ({time.perf_counter() - start:.2f}s)")
+    if failures:
+        sys.exit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    main()
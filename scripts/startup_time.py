@@ -0,0 +1,76 @@
+"""Cold startup time of the plearning CLI, failing if a command exceeds its budget or imports heavy modules"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ["matplotlib", "pandas", "pyarrow", "scipy", "seaborn", "sklearn", "torch", "torchaudio", "tqdm"]
+
+# Command: (budget in seconds of the whole process, modules it must not import)
+BUDGETS = {
+    "--help": (0.6, [*HEAVY_MODULES, "joblib", "numpy"]),
+    "train --help": (0.6, [*HEAVY_MODULES, "joblib", "numpy"]),
+    "evaluate --help": (0.6, [*HEAVY_MODULES, "joblib", "numpy"]),
+    "evaluate best --help": (0.8, HEAVY_MODULES),
+    "evaluate features --help": (0.8, HEAVY_MODULES),
+}
+
+PROBE = """
+import sys
+from plearning.cli import main
+main(sys.argv[1:], prog_name="plearning", standalone_mode=False)
+print(" ".join(sorted(sys.modules)), file=sys.stderr)
+"""
+
+
+def measure(command: str, repeat: int) -> tuple[float, set[str]]:
+    """Fastest wall time of `repeat` fresh processes running the command, and the modules it imported"""
+    best, modules = float("inf"), set()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-c", PROBE, *command.split()],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        best = min(best, time.perf_counter() - start)
+        if process.returncode != 0:
+            raise RuntimeError(f"plearning {command} failed:\n{process.stderr}")
+        modules = set(process.stderr.split())
+    return best, modules
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs of each command, the fastest is kept")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="Factor applied to every time budget")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument(
+        "--imports-only", action="store_true", help="Only check the imported modules, not the time budgets"
+    )
+    args = parser.parse_args()
+    repeat = 1 if args.imports_only else args.repeat
+
+    results, failures = {}, []
+    for command, (budget, forbidden) in BUDGETS.items():
+        seconds, modules = measure(command, repeat)
+        imported = sorted(module for module in forbidden if module in modules)
+        results[command] = {"seconds": round(seconds, 3), "budget": budget * args.tolerance, "heavy": imported}
+        if not args.imports_only and seconds > budget * args.tolerance:
+            failures.append(f"plearning {command}: {seconds:.3f}s, budget {budget * args.tolerance:.3f}s")
+        if imported:
+            failures.append(f"plearning {command} imports {', '.join(imported)}")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for command, result in results.items():
+            print(f"plearning {command:<26} {result['seconds']:.3f}s (budget {result['budget']:.3f}s)")
+    if failures:
+        sys.exit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,16 @@
-from plearning.command import CPCCommands
+from typing import Any
 
-CPC = CPCCommands()
+from plearning.command import CPCCommands
 
 __all__ = ["CPC"]
+
+CPC: CPCCommands
+
+
+def __getattr__(name: str) -> Any:
+    """Build the default commands on first access to `plearning.CPC`"""
+    if name == "CPC":
+        global CPC
+        CPC = CPCCommands()
+        return CPC
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,343 @@
+"""ABX discriminability computed in-process with NumPy"""
+import json
+import pickle
+from collections import defaultdict
+from enum import StrEnum
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from plearning import CPC
+from plearning.features import extract_features, load_feature_function
+from plearning.tokens import TokenIndex, Tokens, file_lengths, index_tokens, load_tokens, slice_tokens
+from plearning.utils import read_item
+
+
+class ABXMode(StrEnum):
+    WITHIN = "within"
+    ACROSS = "across"
+    ALL = "all"
+
+
+def _gather(tokens: Tokens, idx: np.ndarray, size: int) -> np.ndarray:
+    positions = np.minimum(np.arange(size), tokens.lengths[idx, None] - 1)
+    return tokens.frames[tokens.offsets[idx, None] + positions]
+
+
+def _dtw(dist: np.ndarray, last: np.ndarray) -> np.ndarray:
+    """DTW on a batch of frame distances, normalized by the length of the path"""
+    batch, n, m = dist.shape
+    cost = np.full((batch, n + 1, m + 1), np.inf, dtype=dist.dtype)
+    path = np.zeros((batch, n + 1, m + 1), dtype=np.int32)
+    cost[:, 0, 0] = 0
+    for diagonal in range(n + m - 1):
+        i = np.arange(max(0, diagonal - m + 1), min(diagonal, n - 1) + 1)
+        j = diagonal - i
+        candidates = np.stack([cost[:, i, j], cost[:, i, j + 1], cost[:, i + 1, j]])
+        lengths = np.stack([path[:, i, j], path[:, i, j + 1], path[:, i + 1, j]])
+        choice = np.argmin(candidates, axis=0)[None]
+        cost[:, i + 1, j + 1] = dist[:, i, j] + np.take_along_axis(candidates, choice, axis=0)[0]
+        path[:, i + 1, j + 1] = np.take_along_axis(lengths, choice, axis=0)[0] + 1
+    rows = np.arange(batch)
+    return cost[rows, n, last] / path[rows, n, last]
+
+
+def dtw_distances(tokens: Tokens, first: np.ndarray, second: np.ndarray, max_cells: int = 2**23) -> np.ndarray:
+    """Angular DTW distances between pairs of tokens, computed by batches of similar lengths"""
+    swap = tokens.lengths[first] < tokens.lengths[second]
+    first, second = np.where(swap, second, first), np.where(swap, first, second)
+    order = np.lexsort((tokens.lengths[second], tokens.lengths[first]))
+    distances = np.empty(len(order), dtype=np.float32)
+    boundaries = np.flatnonzero(np.diff(tokens.lengths[first[order]])) + 1
+    for group in np.split(order, boundaries):
+        n = int(tokens.lengths[first[group[0]]])
+        m_max = int(tokens.lengths[second[group[-1]]])
+        batch_size = max(1, max_cells // (n * m_max))
+        for start in range(0, len(group), batch_size):
+            batch = group[start : start + batch_size]
+            m = int(tokens.lengths[second[batch]].max())
+            x, y = _gather(tokens, first[batch], n), _gather(tokens, second[batch], m)
+            dist = np.arccos(np.clip(np.einsum("bnd,bmd->bnm", x, y), -1, 1)) / np.pi
+            distances[batch] = _dtw(dist, tokens.lengths[second[batch]])
+    return distances
+
+
+class _DistanceTable:
+    """Symmetric lookup table of the DTW distances between tokens"""
+
+    def __init__(self, tokens: Tokens, first: np.ndarray, second: np.ndarray) -> None:
+        self.size = len(tokens)
+        keys = np.unique(self._keys(first, second))
+        self.keys = keys
+        self.values = dtw_distances(tokens, keys // self.size, keys % self.size)
+
+    def _keys(self, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        return np.minimum(first, second) * self.size + np.maximum(first, second)
+
+    def __call__(self, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        keys = self._keys(first, second)
+        found = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(first == second, 0, self.values[found])
+
+
+def _theta(dxa: np.ndarray, dxb: np.ndarray, symmetric: bool) -> float:
+    """Proportion of (x, a, b) triplets where x is closer to a than to b"""
+    less = dxa[:, :, None] < dxb[:, None, :]
+    equal = dxa[:, :, None] == dxb[:, None, :]
+    n_x, n_a = dxa.shape
+    if symmetric:
+        mask = ~np.eye(n_a, dtype=bool)[:, :, None]
+        less, equal = less & mask, equal & mask
+        n_pos = n_a * (n_a - 1)
+    else:
+        n_pos = n_x * n_a
+    return float((less.sum() + 0.5 * equal.sum()) / (n_pos * dxb.shape[1]))
+
+
+def _cells(tokens: Tokens, selected: np.ndarray) -> dict[tuple[int, int], dict[int, np.ndarray]]:
+    """Tokens indices grouped by (context, speaker), then by phone"""
+    cells: dict[tuple[int, int], dict[int, np.ndarray]] = defaultdict(dict)
+    frame = pd.DataFrame(
+        {"context": tokens.context[selected], "speaker": tokens.speaker[selected], "phone": tokens.phone[selected]}
+    )
+    for (context, speaker, phone), indices in frame.groupby(["context", "speaker", "phone"]).indices.items():
+        cells[(context, speaker)][phone] = selected[indices]
+    return cells
+
+
+def _subsample(tokens: Tokens, max_size_group: int, rng: np.random.Generator) -> np.ndarray:
+    shuffled = rng.permutation(len(tokens))
+    frame = pd.DataFrame({"context": tokens.context, "speaker": tokens.speaker, "phone": tokens.phone}).iloc[shuffled]
+    return np.sort(shuffled[frame.groupby(["context", "speaker", "phone"]).cumcount().to_numpy() < max_size_group])
+
+
+def _pairs_product(first: np.ndarray, second: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    return np.repeat(first, len(second)), np.tile(second, len(first))
+
+
+def abx_within(tokens: Tokens, max_size_group: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    """Sum and count of the ABX errors within speakers, for each (speaker, phone A, phone B)"""
+    cells = _cells(tokens, _subsample(tokens, max_size_group, rng))
+    groups = [phones for phones in cells.values() if len(phones) > 1]
+    first, second = [], []
+    for phones in groups:
+        indices = np.concatenate(list(phones.values()))
+        upper = np.triu_indices(len(indices), k=1)
+        first.append(indices[upper[0]])
+        second.append(indices[upper[1]])
+    n_speakers, n_phones = tokens.speaker.max() + 1, len(tokens.phone_match)
+    sums, counts = np.zeros((n_speakers, n_phones, n_phones)), np.zeros((n_speakers, n_phones, n_phones))
+    if not groups:
+        return sums, counts
+    distance = _DistanceTable(tokens, np.concatenate(first), np.concatenate(second))
+    for phones in groups:
+        for phone_a, a in phones.items():
+            if len(a) < 2:
+                continue
+            dxa = distance(a[:, None], a[None, :])
+            for phone_b, b in phones.items():
+                if phone_b == phone_a:
+                    continue
+                error = 1 - _theta(dxa, distance(a[:, None], b[None, :]), symmetric=True)
+                speaker = tokens.speaker[a[0]]
+                sums[speaker, phone_a, phone_b] += error
+                counts[speaker, phone_a, phone_b] += 1
+    return sums, counts
+
+
+def abx_across(
+    tokens: Tokens, max_size_group: int, max_x_across: int, rng: np.random.Generator
+) -> tuple[np.ndarray, np.ndarray]:
+    """Sum and count of the ABX errors across speakers, for each (speaker of A and B, phone A, phone B)"""
+    cells = _cells(tokens, _subsample(tokens, max_size_group, rng))
+    by_context: dict[int, dict[int, dict[int, np.ndarray]]] = defaultdict(dict)
+    for (context, speaker), phones in cells.items():
+        by_context[context][speaker] = phones
+
+    groups, first, second = [], [], []
+    for speakers in by_context.values():
+        if len(speakers) < 2:
+            continue
+        for speaker_ab, phones in speakers.items():
+            for phone_a, a in phones.items():
+                candidates = [spk for spk, other in speakers.items() if spk != speaker_ab and phone_a in other]
+                if len(candidates) > max_x_across:
+                    candidates = list(rng.choice(candidates, size=max_x_across, replace=False))
+                for phone_b, b in phones.items():
+                    if phone_b == phone_a:
+                        continue
+                    for speaker_x in candidates:
+                        x = speakers[speaker_x][phone_a]
+                        groups.append((speaker_ab, phone_a, phone_b, a, b, x))
+                        for pair in (_pairs_product(x, a), _pairs_product(x, b)):
+                            first.append(pair[0])
+                            second.append(pair[1])
+
+    n_speakers, n_phones = tokens.speaker.max() + 1, len(tokens.phone_match)
+    sums, counts = np.zeros((n_speakers, n_phones, n_phones)), np.zeros((n_speakers, n_phones, n_phones))
+    if not groups:
+        return sums, counts
+    distance = _DistanceTable(tokens, np.concatenate(first), np.concatenate(second))
+    for speaker_ab, phone_a, phone_b, a, b, x in groups:
+        dxa, dxb = distance(x[:, None], a[None, :]), distance(x[:, None], b[None, :])
+        sums[speaker_ab, phone_a, phone_b] += 1 - _theta(dxa, dxb, symmetric=False)
+        counts[speaker_ab, phone_a, phone_b] += 1
+    return sums, counts
+
+
+def reduce_confusion(sums: np.ndarray, counts: np.ndarray) -> tuple[np.ndarray, np.ndarray, float]:
+    """Average the errors over contexts, then over speakers, then over phone pairs"""
+    by_speaker = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    divisor_speaker = (counts > 0).sum(axis=0)
+    phone_confusion = np.divide(
+        by_speaker.sum(axis=0), divisor_speaker, out=np.zeros(divisor_speaker.shape), where=divisor_speaker > 0
+    )
+    score = float(phone_confusion.sum() / max((divisor_speaker > 0).sum(), 1))
+    return phone_confusion, divisor_speaker, score
+
+
+def write_results(
+    output: Path, mode: str, args: dict, phone_match: dict[str, int], sums: np.ndarray, counts: np.ndarray
+) -> float:
+    """Write ABX_args.json, ABX_scores.json and extras.pkl as CPC3 eval_abx does"""
+    phone_confusion, divisor_speaker, score = reduce_confusion(sums, counts)
+    output.mkdir(parents=True, exist_ok=True)
+    with open(output / "ABX_args.json", "w") as file:
+        json.dump({**args, "mode": mode}, file, indent=2)
+    with open(output / "ABX_scores.json", "w") as file:
+        json.dump({mode: score}, file, indent=2)
+    extras = {
+        "phone_match": phone_match,
+        f"phone_confusion_{mode}": phone_confusion,
+        f"divisor_speaker_{mode}": divisor_speaker,
+    }
+    with open(output / "extras.pkl", "wb") as file:
+        pickle.dump(extras, file)
+    return score
+
+
+def score_tokens(
+    tokens: Tokens,
+    output: Path,
+    mode: ABXMode,
+    args: dict,
+    max_size_group: int = 10,
+    max_x_across: int = 5,
+    seed: int = 0,
+) -> dict[str, float]:
+    """Compute and write ABX error rates of the tokens, in `output/{mode}` for each mode if `mode` is all"""
+    modes = [ABXMode.WITHIN, ABXMode.ACROSS] if mode == ABXMode.ALL else [mode]
+    scores: dict[str, float] = {}
+    for current in modes:
+        rng = np.random.default_rng(seed)
+        if current == ABXMode.WITHIN:
+            sums, counts = abx_within(tokens, max_size_group, rng)
+        else:
+            sums, counts = abx_across(tokens, max_size_group, max_x_across, rng)
+        out = output / current if mode == ABXMode.ALL else output
+        scores[current] = write_results(out, current, args, tokens.phone_match, sums, counts)
+        print(f"ABX {current}: {scores[current]}")
+    return scores
+
+
+def _abx_args(
+    checkpoint: Path, item: Path, feature_size: float, max_size_group: int, max_x_across: int, seed: int
+) -> dict:
+    return {
+        "path_checkpoint": str(checkpoint),
+        "path_item_file": str(item),
+        "feature_size": feature_size,
+        "max_size_group": max_size_group,
+        "max_x_across": max_x_across,
+        "distance_mode": "cosine",
+        "seed": seed,
+    }
+
+
+def compute_abx(
+    item: Path,
+    features: Path,
+    output: Path,
+    mode: ABXMode = ABXMode.ALL,
+    feature_size: float = 0.01,
+    max_size_group: int = 10,
+    max_x_across: int = 5,
+    seed: int = 0,
+) -> None:
+    """Compute ABX error rates of pre-computed features, in-process"""
+    item, features, output = item.resolve(), features.resolve(), output.resolve()
+    assert item.is_file()
+    assert features.is_dir()
+    tokens = load_tokens(item, features, feature_size)
+    args = _abx_args(features, item, feature_size, max_size_group, max_x_across, seed)
+    score_tokens(tokens, output, mode, args, max_size_group, max_x_across, seed)
+
+
+def is_evaluated(output: Path) -> bool:
+    """Whether both ABX modes have been computed in `output`"""
+    return all((output / mode / file).is_file() for mode in ["within", "across"] for file in CPC.evaluation_files)
+
+
+def read_scores(output: Path) -> dict[str, float]:
+    """Scores of both ABX modes computed in `output`"""
+    scores = {}
+    for mode in ["within", "across"]:
+        with open(output / mode / "ABX_scores.json", "r") as file:
+            scores[mode] = float(json.load(file)[mode])
+    return scores
+
+
+def checkpoint_scores(
+    checkpoint: Path,
+    outputs: dict[str, Path],
+    indices: dict[str, tuple[np.ndarray, TokenIndex]],
+    feature_size: float = 0.01,
+    max_size_group: int = 10,
+    max_x_across: int = 5,
+    seed: int = 0,
+    overwrite: bool = False,
+) -> dict[tuple[str, str], float]:
+    """Scores of a checkpoint on each test set, computed in `outputs[test]` if missing, reusing the token indices"""
+    scores = {}
+    to_evaluate = {}
+    for test, out in outputs.items():
+        if overwrite or not is_evaluated(out):
+            to_evaluate[test] = out
+        else:
+            scores.update({(test, mode): score for mode, score in read_scores(out).items()})
+    if not to_evaluate:
+        return scores
+
+    feature_function = load_feature_function(checkpoint)
+    for test, out in to_evaluate.items():
+        item = CPC.test_items[test]
+        item_df = read_item(item)
+        features = extract_features(feature_function, item_df, item.parent)
+        files = np.asarray(item_df["seg_id"].unique(), dtype=str)
+        lengths = file_lengths(features, files)
+        if test not in indices or not np.array_equal(indices[test][0], lengths):
+            indices[test] = (lengths, index_tokens(item_df, lengths, files, feature_size))
+        tokens = slice_tokens(indices[test][1], features)
+        args = _abx_args(checkpoint, item, feature_size, max_size_group, max_x_across, seed)
+        print(f"Test set {test}")
+        for mode, score in score_tokens(tokens, out, ABXMode.ALL, args, max_size_group, max_x_across, seed).items():
+            scores[(test, mode)] = score
+    return scores
+
+
+def evaluate_checkpoint(
+    checkpoint: Path,
+    output: Path,
+    relative: Path,
+    feature_size: float = 0.01,
+    max_size_group: int = 10,
+    max_x_across: int = 5,
+    seed: int = 0,
+    overwrite: bool = False,
+) -> None:
+    """Load a checkpoint once and compute both ABX modes on every test set, in `output/{test}/{relative}/{mode}`"""
+    checkpoint, output = checkpoint.resolve(), output.resolve()
+    assert checkpoint.is_file()
+    outputs = {test: output / test / relative for test in CPC.test_items}
+    checkpoint_scores(checkpoint, outputs, {}, feature_size, max_size_group, max_x_across, seed, overwrite)
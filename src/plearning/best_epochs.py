@@ -1,29 +1,102 @@
-import subprocess
+import json
+import os
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
+from joblib import Parallel, delayed
+
+from plearning.walk import find_files
+
+
+def _mean_accuracy(accuracy: Any) -> float:
+    values = (
+        []
+        if accuracy is None
+        else [value for value in np.ravel(np.array(accuracy, dtype=object)) if value is not None]
+    )
+    return float(np.mean(values)) if values else np.nan
+
+
+def best_epoch_from_logs(
+    directory: Path, min_epoch: Optional[int] = None, max_epoch: Optional[int] = None
+) -> Optional[int]:
+    """Epoch with the best validation accuracy in `checkpoint_logs.json`, among the epochs with a checkpoint
+
+    Epochs without accuracy, logged as None after a resumed run, are skipped.
+    """
+    with open(directory / "checkpoint_logs.json", "r") as file:
+        logs = json.load(file)
+    accuracies = np.array([_mean_accuracy(accuracy) for accuracy in logs["locAcc_val"]])
+    epochs = np.arange(len(accuracies))
+    files = set(os.listdir(directory))
+    valid = ~np.isnan(accuracies) & np.array([f"checkpoint_{epoch}.pt" in files for epoch in epochs], dtype=bool)
+    if min_epoch is not None:
+        valid &= epochs >= min_epoch
+    if max_epoch is not None:
+        valid &= epochs <= max_epoch
+    if not valid.any():
+        return None
+    return int(epochs[valid][np.argmax(accuracies[valid])])
+
+
+def _stamp(directory: str) -> list[tuple[str, int, int]]:
+    """Name, mtime and size of the logs and of the checkpoints, on which the best epoch depends"""
+    stamp = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name == "checkpoint_logs.json" or (
+                entry.name.startswith("checkpoint_") and entry.name.endswith(".pt")
+            ):
+                stat = entry.stat()
+                stamp.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    return sorted(stamp)
+
+
+def _safe_best_epoch(directory: Path, min_epoch: Optional[int], max_epoch: Optional[int]) -> Optional[int]:
+    try:
+        return best_epoch_from_logs(directory, min_epoch, max_epoch)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
 
 
 def best_epochs(
-    cpc_script: Path, root: Path, output: Path, min_epoch: Optional[int] = None, max_epoch: Optional[int] = None
+    root: Path,
+    output: Path,
+    min_epoch: Optional[int] = None,
+    max_epoch: Optional[int] = None,
+    n_jobs: int = -1,
+    cache: Optional[Path] = None,
 ) -> None:
     """Find best epoch of each experiment based on the accuracy on the validation set"""
+    cache = output.with_suffix(".cache.json") if cache is None else cache
+    cached = json.loads(cache.read_text()) if cache.is_file() else {}
+    directories = sorted({str(path.parent) for path in find_files(root, "checkpoint_logs.json", n_jobs=n_jobs)})
+    stamping = Parallel(n_jobs=n_jobs, prefer="threads")(delayed(_stamp)(directory) for directory in directories)
+    stamps = {directory: [list(entry) for entry in stamp] for directory, stamp in zip(directories, stamping)}
+    key = [min_epoch, max_epoch]
+
+    to_parse = [
+        directory
+        for directory in directories
+        if directory not in cached
+        or cached[directory].get("stamp") != stamps[directory]
+        or cached[directory]["key"] != key
+        or cached[directory]["epoch"] is None
+    ]
+    launcher = Parallel(n_jobs=n_jobs, verbose=10)
+    parsed = launcher(delayed(_safe_best_epoch)(Path(directory), min_epoch, max_epoch) for directory in to_parse)
+    for directory, epoch in zip(to_parse, parsed):
+        cached[directory] = {"stamp": stamps[directory], "key": key, "epoch": epoch}
+    cached = {directory: cached[directory] for directory in directories}
+    cache.write_text(json.dumps(cached, indent=2))
+
     model, epoch = [], []
-    cmd = ["python", str(cpc_script.resolve())]
-    if min_epoch is not None:
-        cmd += ["--min", str(min_epoch)]
-    if max_epoch is not None:
-        cmd += ["--max", str(max_epoch)]
-    cmd.append("--model_path")
-    checkpoints = np.unique([path.parent for path in root.resolve().rglob("*.pt")])
-    for directory in tqdm(checkpoints):
-        completed = subprocess.run(cmd + [directory], text=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        if completed.returncode != 0:
+    for directory in directories:
+        if cached[directory]["epoch"] is None:
             print(f"Failed for {directory}")
             continue
-        model.append(str(directory))
-        epoch.append(int(completed.stdout.split(" ")[-1]))
+        model.append(directory)
+        epoch.append(cached[directory]["epoch"])
     pd.DataFrame({"model": model, "epoch": epoch}).to_csv(output, index=False)
@@ -0,0 +1,102 @@
+"""Content-addressed cache of ABX results, shared by every output tree"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+from plearning import CPC
+
+HASHES = "hashes.json"
+PENDING = "cache_pending.json"
+SHARED_FILES = ["ABX_scores.json", "extras.pkl"]
+
+
+class ResultCache:
+    """ABX results stored once per (content of the checkpoint or features, item file, mode, evaluation options)"""
+
+    def __init__(self, root: Optional[Path] = None) -> None:
+        self.root = (CPC.cache if root is None else root).resolve() / "abx"
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._hashes: dict[str, list] = {}
+        if (self.root / HASHES).is_file():
+            self._hashes = json.loads((self.root / HASHES).read_text())
+        self._dirty = False
+
+    def file_digest(self, path: Path) -> str:
+        """Digest of the content of a file, memoized by resolved path, size and mtime"""
+        path = path.resolve()
+        stat = path.stat()
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        cached = self._hashes.get(str(path))
+        if cached is not None and cached[:2] == stamp:
+            return cached[2]
+        with open(path, "rb") as file:
+            digest = hashlib.file_digest(file, "sha256").hexdigest()
+        self._hashes[str(path)] = [*stamp, digest]
+        self._dirty = True
+        return digest
+
+    def content_digest(self, path: Path) -> str:
+        """Digest of a checkpoint file, or of every file of a feature directory"""
+        if path.is_file():
+            return self.file_digest(path)
+        digest = hashlib.sha256()
+        for file in sorted(p for p in path.resolve().rglob("*") if p.is_file()):
+            digest.update(f"{file.relative_to(path.resolve())} {self.file_digest(file)}\n".encode())
+        return digest.hexdigest()
+
+    def key(self, checkpoint: Path, item: Path, mode: str, template: str) -> str:
+        """Cache key of the evaluation of `checkpoint` on `item` with a given command template"""
+        parts = [self.content_digest(checkpoint), self.file_digest(item), mode, CPC.appendix, template]
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def __contains__(self, key: str) -> bool:
+        return all((self.path(key) / file).is_file() for file in CPC.evaluation_files)
+
+    def store(self, key: str, output: Path) -> None:
+        """Add a copy of the results in `output` to the cache, as outputs can be rewritten in place"""
+        if key in self or not all((output / file).is_file() for file in CPC.evaluation_files):
+            return
+        self.path(key).parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=self.path(key).parent, prefix=".tmp"))
+        for file in CPC.evaluation_files:
+            shutil.copy2(output / file, tmp / file)
+        try:
+            os.rename(tmp, self.path(key))
+        except OSError:  # Stored meanwhile by a concurrent job
+            shutil.rmtree(tmp)
+
+    def restore(self, key: str, output: Path, checkpoint: Path, item: Path) -> None:
+        """Copy the cached results into `output`, with arguments pointing to `checkpoint` and `item`"""
+        output.mkdir(parents=True, exist_ok=True)
+        for file in SHARED_FILES:
+            shutil.copy2(self.path(key) / file, output / file)
+        args = json.loads((self.path(key) / "ABX_args.json").read_text())
+        args["path_checkpoint"], args["path_item_file"] = str(checkpoint), str(item)
+        (output / "ABX_args.json").write_text(json.dumps(args, indent=2))
+
+    def save(self) -> None:
+        if self._dirty:
+            with tempfile.NamedTemporaryFile("w", dir=self.root, suffix=".tmp", delete=False) as file:
+                json.dump(self._hashes, file)
+            os.replace(file.name, self.root / HASHES)
+            self._dirty = False
+
+
+def write_pending(output: Path, cache: ResultCache, pending: dict[str, list[tuple[str, str]]]) -> None:
+    """Record the cache keys and output directories of the jobs of a plan, to store their results once they succeed"""
+    (output / PENDING).write_text(json.dumps({"root": str(cache.root.parent), "jobs": pending}))
+
+
+def read_pending(plan_dir: Path) -> tuple[Optional[ResultCache], dict[str, list[tuple[str, str]]]]:
+    """Cache and pending entries of each job recorded next to a plan, if any"""
+    if not (plan_dir / PENDING).is_file():
+        return None, {}
+    pending = json.loads((plan_dir / PENDING).read_text())
+    return ResultCache(Path(pending["root"])), pending["jobs"]
@@ -1,37 +1,115 @@
+"""Command line interface, importing the module of a command only when it is invoked"""
+import ast
+import importlib
+import importlib.util
+from typing import Any, Optional
+
 import typer
+from typer.core import TyperCommand, TyperGroup
+
+
+class LazyCommand(TyperCommand):
+    """Placeholder of a command implemented by `target` ("module:function"), listed without importing it"""
+
+    def __init__(self, name: str, target: str) -> None:
+        super().__init__(name)
+        self.target = target
+
+    def summary(self) -> str:
+        """Docstring of the target function, read from the source of its module"""
+        module, function = self.target.split(":")
+        spec = importlib.util.find_spec(module)
+        if spec is None or spec.origin is None:
+            return ""
+        with open(spec.origin) as file:
+            tree = ast.parse(file.read())
+        for node in tree.body:
+            if isinstance(node, ast.FunctionDef) and node.name == function:
+                return ast.get_docstring(node) or ""
+        return ""
+
+    def load(self) -> Any:
+        """Import the target function and build the real command"""
+        module, function = self.target.split(":")
+        app = typer.Typer(add_completion=False)
+        app.command(name=self.name)(getattr(importlib.import_module(module), function))
+        return typer.main.get_command(app)
+
+
+class LazyGroup(TyperGroup):
+    """Group whose lazy commands are loaded when resolved for invocation or completion"""
+
+    def get_command(self, ctx: Any, cmd_name: str) -> Any:
+        command = super().get_command(ctx, cmd_name)
+        if isinstance(command, LazyCommand) and command.help is None:
+            command.help = command.summary()
+        return command
+
+    def resolve_command(self, ctx: Any, args: list[str]) -> tuple[Optional[str], Any, list[str]]:
+        command = self.commands.get(args[0]) if args else None
+        if isinstance(command, LazyCommand):
+            self.commands[args[0]] = command.load()
+        return super().resolve_command(ctx, args)
+
+
+data = LazyGroup(
+    name="data",
+    help="Data processing utilities",
+    commands=[
+        LazyCommand("partition", "plearning.data.partition:create_partitions"),
+        LazyCommand("materialize", "plearning.data.partition:materialize_partitions"),
+        LazyCommand("segment", "plearning.data.processor:create_segments"),
+        LazyCommand("compare-engines", "plearning.data.processor:compare_engines"),
+        LazyCommand("remix", "plearning.data.processor:process_audio"),
+        LazyCommand("vad", "plearning.data.vad:vad"),
+        LazyCommand("verify", "plearning.data.verify:verify"),
+        LazyCommand("info", "plearning.datasets:dataset_info"),
+    ],
+)
+
+evaluate = LazyGroup(
+    name="evaluate",
+    help="Create jobs to evaluate models on ABX tasks",
+    commands=[
+        LazyCommand("best", "plearning.evaluate:evaluate_cpc_best_epochs"),
+        LazyCommand("features", "plearning.evaluate:evaluate_cpc_pre_computed"),
+        LazyCommand("mfcc", "plearning.evaluate:evaluate_mfcc"),
+        LazyCommand("sweep", "plearning.sweep:evaluate_sweep"),
+    ],
+)
+
+warehouse = LazyGroup(
+    name="warehouse",
+    help="Local SQLite warehouse of ABX scores",
+    commands=[
+        LazyCommand("ingest", "plearning.warehouse:ingest_results"),
+        LazyCommand("import", "plearning.warehouse:import_scores"),
+        LazyCommand("stats", "plearning.warehouse:print_stats"),
+    ],
+)
 
-from plearning.archive import archive
-from plearning.best_epochs import best_epochs
-from plearning.data import create_partitions, create_segments, process_audio, vad, verify
-from plearning.evaluate import evaluate_cpc_best_epochs, evaluate_cpc_pre_computed, evaluate_mfcc
-from plearning.mfcc import compute_mfcc
-from plearning.pairs import abx_pairs
-from plearning.scores import recap_scores
-from plearning.train import launch_training
-from plearning.tsne import build_tsne
-
-data = typer.Typer(help="Data processing utilities", pretty_exceptions_enable=False)
-data.command(name="partition")(create_partitions)
-data.command(name="segment")(create_segments)
-data.command(name="remix")(process_audio)
-data.command(name="vad")(vad)
-data.command(name="verify")(verify)
-
-evaluate = typer.Typer(help="Create jobs to evaluate models on ABX tasks", pretty_exceptions_enable=False)
-evaluate.command(name="best")(evaluate_cpc_best_epochs)
-evaluate.command(name="features")(evaluate_cpc_pre_computed)
-evaluate.command(name="mfcc")(evaluate_mfcc)
-
-main = typer.Typer(help="Perceptual narrowing with CPC", pretty_exceptions_enable=False)
-main.add_typer(data, name="data")
-main.add_typer(evaluate, name="evaluate")
-main.command(name="train")(launch_training)
-main.command(name="pairs")(abx_pairs)
-main.command(name="scores")(recap_scores)
-main.command(name="mfcc")(compute_mfcc)
-main.command(name="best_epochs")(best_epochs)
-main.command(name="tsne")(build_tsne)
-main.command(name="archive")(archive)
+main = LazyGroup(
+    help="Perceptual narrowing with CPC",
+    params=list(typer.main.get_install_completion_arguments()),
+    commands=[
+        LazyCommand("train", "plearning.train:launch_training"),
+        LazyCommand("pairs", "plearning.pairs:abx_pairs"),
+        LazyCommand("scores", "plearning.scores:recap_scores"),
+        LazyCommand("mfcc", "plearning.mfcc:compute_mfcc"),
+        LazyCommand("best_epochs", "plearning.best_epochs:best_epochs"),
+        LazyCommand("tsne", "plearning.tsne:build_tsne"),
+        LazyCommand("tsne_embed", "plearning.tsne:embed_tsne"),
+        LazyCommand("archive", "plearning.archive:archive"),
+        LazyCommand("abx", "plearning.abx:compute_abx"),
+        LazyCommand("abx_checkpoint", "plearning.abx:evaluate_checkpoint"),
+        LazyCommand("store", "plearning.store:convert_features"),
+        LazyCommand("run", "plearning.runner:run_plan"),
+        LazyCommand("significance", "plearning.significance:significance"),
+        data,
+        evaluate,
+        warehouse,
+    ],
+)
 
 if __name__ == "__main__":
     main()
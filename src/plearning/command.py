@@ -1,6 +1,11 @@
 import dataclasses
+import functools
 import os
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from plearning.datasets import DatasetRegistry
 
 
 def default_data_directory() -> Path:
@@ -20,6 +25,8 @@ class CPCCommands:
     max_size_seq: int = 64000
     file_extension: str = ".wav"
     data_dir: str = ""
+    cache_dir: str = ""
+    datasets_file: str = ""
 
     evaluation_files: list[str] = dataclasses.field(
         default_factory=lambda: ["ABX_args.json", "ABX_scores.json", "extras.pkl"]
@@ -31,17 +38,29 @@ class CPCCommands:
             return default_data_directory()
         return Path(self.data_dir).resolve()
 
+    @property
+    def cache(self) -> Path:
+        if not self.cache_dir:
+            return self.data.parent / "cache"
+        return Path(self.cache_dir).resolve()
+
+    @functools.cached_property
+    def datasets(self) -> "DatasetRegistry":
+        from plearning.datasets import DEFAULT_REGISTRY, DatasetRegistry  # imports plearning.CPC
+
+        config = Path(self.datasets_file).resolve() if self.datasets_file else None
+        try:
+            data, cache = self.data, self.cache
+        except KeyError:
+            # Without a data directory, only the names and languages of the default datasets are known
+            if config is None:
+                return DatasetRegistry.from_dict(DEFAULT_REGISTRY, None, None, self.file_extension)
+            raise
+        return DatasetRegistry.from_file(data, cache, config, self.file_extension)
+
     @property
     def test_items(self) -> dict[str, Path]:
-        test_items = {
-            "csj": self.data / "CSJ/test/test.item",
-            "gpj": self.data / "GPJ/test/test.item",
-            "buc": self.data / "BUC/test/test.item",
-            "wsj": self.data / "WSJ/test/test.item",
-        }
-        for test, path in test_items.items():
-            assert path.is_file(), test
-        return test_items
+        return self.datasets.test_items()
 
     @property
     def appendix(self) -> str:
@@ -59,3 +78,9 @@ class CPCCommands:
 
     def evaluation_from_pre_computed(self) -> str:
         return "python {eval_abx} from_pre_computed {item} {dataset} --file_extension .pt --mode {mode} --out {out}"
+
+    def evaluation_native(self) -> str:
+        return "plearning abx {item} {dataset} {out} --mode {mode}"
+
+    def evaluation_packed(self) -> str:
+        return "plearning abx_checkpoint {checkpoint} {output} {relative}"
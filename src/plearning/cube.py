@@ -0,0 +1,116 @@
+"""Scores indexed by integer-coded dimensions, for repeated selections in analysis code"""
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+
+from plearning import CPC
+from plearning.datasets import DatasetKind
+from plearning.phone_pair import PhonePair
+from plearning.scores import load_scores
+
+# Ordered by increasing number of values, so that usual selections are few contiguous ranges
+DIMENSIONS = ["mode", "test", "train", "split", "phone_pair", "idx", "epoch"]
+MAX_RANGES_FRACTION = 1 / 16
+
+
+def _is_missing(value: Any) -> bool:
+    return value is None or (isinstance(value, PhonePair) and value.first is None)
+
+
+class ScoreCube:
+    """Scores sorted by the codes of their dimensions, where a selection is a union of ranges found by binary search
+
+    Code 0 of each dimension stands for missing values, such as the phone pair of the score on all pairs.
+    """
+
+    def __init__(self, scores: pd.DataFrame, dimensions: Sequence[str] = DIMENSIONS) -> None:
+        self.dimensions = [dimension for dimension in dimensions if dimension in scores.columns]
+        self.categories: dict[str, pd.Index] = {}
+        codes = []
+        for dimension in self.dimensions:
+            code, categories = pd.factorize(scores[dimension], sort=True)
+            codes.append(code.astype(np.int64) + 1)
+            self.categories[dimension] = pd.Index(categories)
+        sizes = [len(self.categories[dimension]) + 1 for dimension in self.dimensions]
+        assert np.prod(sizes, dtype=float) < 2**62, "Too many dimension values to build a single key"
+        self._strides = np.cumprod([1, *sizes[:0:-1]])[::-1].astype(np.int64)
+
+        key = sum((code * stride for code, stride in zip(codes, self._strides)), np.zeros(len(scores), dtype=np.int64))
+        order = np.argsort(key, kind="stable")
+        self.frame = scores.iloc[order].reset_index(drop=True)
+        self.codes = {dimension: code[order] for dimension, code in zip(self.dimensions, codes)}
+        self._key = key[order]
+
+    @classmethod
+    def read(cls, path: Path, dimensions: Sequence[str] = DIMENSIONS) -> "ScoreCube":
+        """Cube of the scores written by `plearning scores`, as CSV, Parquet or Feather"""
+        return cls(load_scores(path), dimensions)
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def value_codes(self, dimension: str, value: Any) -> np.ndarray:
+        """Sorted codes of a value, or of a list of values, of a dimension"""
+        if dimension not in self.codes:
+            raise KeyError(f"{dimension} is not a dimension of the cube")
+        categories = self.categories[dimension]
+        codes: list[int] = []
+        for single in value if isinstance(value, (list, tuple, set)) else [value]:
+            if _is_missing(single):
+                codes.append(0)
+            elif isinstance(single, PhonePair):
+                codes.extend(1 + np.flatnonzero([single == category for category in categories]))
+            elif single in categories:
+                codes.append(1 + categories.get_loc(single))
+        return np.unique(np.asarray(codes, dtype=np.int64))
+
+    def rows(self, **selection: Any) -> np.ndarray:
+        """Sorted positions in `frame` of the scores whose dimensions take the selected values"""
+        selected = {dimension: self.value_codes(dimension, value) for dimension, value in selection.items()}
+        if not selected:
+            return np.arange(len(self))
+        if any(len(codes) == 0 for codes in selected.values()):
+            return np.array([], dtype=np.int64)
+
+        last = max(self.dimensions.index(dimension) for dimension in selected)
+        choices = [
+            selected.get(dimension, np.arange(len(self.categories[dimension]) + 1))
+            for dimension in self.dimensions[: last + 1]
+        ]
+        if np.prod([len(choice) for choice in choices], dtype=float) > MAX_RANGES_FRACTION * len(self):
+            mask = np.logical_and.reduce(
+                [np.isin(self.codes[dimension], codes) for dimension, codes in selected.items()]
+            )
+            return np.flatnonzero(mask)
+
+        prefixes = np.zeros(1, dtype=np.int64)
+        for choice, stride in zip(choices, self._strides):
+            prefixes = (prefixes[:, None] + choice[None, :] * stride).ravel()
+        starts = np.searchsorted(self._key, prefixes, side="left")
+        lengths = np.searchsorted(self._key, prefixes + self._strides[last], side="left") - starts
+        offsets = np.cumsum(lengths) - lengths
+        return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+    def select(self, **selection: Any) -> pd.DataFrame:
+        """Scores whose dimensions take the selected values, a value being a single value or a list of them"""
+        return self.frame.iloc[self.rows(**selection)]
+
+    def native_nonnative(
+        self, datasets: list[str], languages: Optional[Mapping[str, Optional[str]]] = None, **selection: Any
+    ) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Scores of models tested on their training language, and on another language, on the given test sets"""
+        if languages is None:
+            languages = {name: CPC.datasets.language(name) for name in CPC.datasets.datasets}
+        trains = [name for name in CPC.datasets.names(DatasetKind.TRAIN) if languages.get(name) is not None]
+        rows = self.rows(**{**selection, "test": datasets, "train": [languages[name] for name in trains]})
+
+        tests, train_categories = self.categories["test"], self.categories["train"]
+        native = np.zeros((len(tests) + 1, len(train_categories) + 1), dtype=bool)
+        for test in datasets:
+            if test in tests and languages.get(test) in train_categories:
+                native[1 + tests.get_loc(test), 1 + train_categories.get_loc(languages[test])] = True
+        is_native = native[self.codes["test"][rows], self.codes["train"][rows]]
+        return self.frame.iloc[rows[is_native]], self.frame.iloc[rows[~is_native]]
@@ -1,6 +1,14 @@
-from plearning.data.partition import create_partitions, symlink_data
+from plearning.data.partition import create_partitions, materialize_partitions, symlink_data
 from plearning.data.processor import create_segments, process_audio
 from plearning.data.vad import vad
 from plearning.data.verify import verify
 
-__all__ = ["create_partitions", "create_segments", "process_audio", "symlink_data", "vad", "verify"]
+__all__ = [
+    "create_partitions",
+    "create_segments",
+    "materialize_partitions",
+    "process_audio",
+    "symlink_data",
+    "vad",
+    "verify",
+]
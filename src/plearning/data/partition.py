@@ -1,35 +1,59 @@
 """Split training sets"""
-from enum import StrEnum
+import heapq
+import json
+import os
+import shutil
+import tempfile
 from pathlib import Path
+from typing import Optional
 
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 from tqdm import tqdm
 
+from plearning.keys import GroupbyKey
+
 SPLIT_FACTORS: list[int] = [5, 5, 5, 4]  # Split in 5, then 25, 125, and 500
 
 
-class GroupbyKey(StrEnum):
-    SEGMENT = "seg_id"
-    FILE = "talk_id"
-    SPEAKER = "speaker_id"
+def hierarchical_split(durations: np.ndarray, split_factors: list[int], lpt: bool = False) -> np.ndarray:
+    """Greedy split of integer-coded keys at every level, each key going to the lightest bin of its parent.
+
+    Keys are assigned in increasing order, or by decreasing duration with `lpt` (longest processing time).
+    Returns the bin of each key at each level, of shape (number of levels, number of keys).
+    """
+    order = np.argsort(-durations, kind="stable") if lpt else np.arange(len(durations))
+    key_durations = durations.tolist()
+    parents = [0] * len(durations)
+    levels = []
+    for split_factor in split_factors:
+        bins = [0] * len(durations)
+        heaps: dict[int, list[tuple[float, int]]] = {}
+        for key in order.tolist():
+            parent = parents[key]
+            if parent not in heaps:
+                heaps[parent] = [(0.0, idx) for idx in range(split_factor)]
+            duration, idx = heaps[parent][0]
+            heapq.heapreplace(heaps[parent], (duration + key_durations[key], idx))
+            bins[key] = parent * split_factor + idx
+        levels.append(bins)
+        parents = bins
+    return np.array(levels, dtype=np.int64).reshape(len(split_factors), len(durations))
 
 
-def greedy_split(all_segments: list[pd.DataFrame], split: int, groupby_key: GroupbyKey) -> list[pd.DataFrame]:
-    """Simple split by a greedy algorithm"""
-    result = []
-    for segments in all_segments:
-        indices: list[list[int]] = [[] for _ in range(split)]
-        durations = np.zeros(split)
-        duration_by_key = segments.groupby(groupby_key)["duration"].sum()
-        for idx, duration in duration_by_key.items():
-            min_idx = np.argmin(durations)
-            indices[min_idx].append(idx)
-            durations[min_idx] += duration
-        for idx in indices:
-            current_keys = duration_by_key.loc[idx].index
-            result.append(segments[segments[groupby_key].isin(current_keys)])
-    return result
+def balance_report(durations: np.ndarray, bins: np.ndarray, split: int) -> dict[str, float | list[float]]:
+    """Total duration of each bin and the relative imbalance between the bins"""
+    bin_durations = np.bincount(bins, weights=durations, minlength=split)
+    mean = bin_durations.mean()
+    return {
+        "min": float(bin_durations.min()),
+        "max": float(bin_durations.max()),
+        "mean": float(mean),
+        "std": float(bin_durations.std()),
+        "imbalance": float((bin_durations.max() - bin_durations.min()) / mean) if mean > 0 else 0.0,
+        "durations": bin_durations.tolist(),
+    }
 
 
 def symlink_data(
@@ -42,40 +66,105 @@ def symlink_data(
             (destination / str(speaker_id)).symlink_to(input_dir / str(speaker_id), True)
         elif groupby_key == GroupbyKey.SEGMENT:
             (destination / str(speaker_id)).mkdir()
-            for _, row in subdf.iterrows():
-                file = f"{row['seg_id']}.wav"
+            for seg_id in subdf["seg_id"]:
+                file = f"{seg_id}.wav"
                 (destination / f"{speaker_id}/{file}").symlink_to(input_dir / f"{speaker_id}/{file}")
         else:
             raise NotImplementedError(f"Symlink not implemented for {groupby_key}")
 
 
+def write_manifest(segments: pd.DataFrame, destination: Path) -> None:
+    """List the segments of a partition, one per line, as expected by the `--pathTrain` option of CPC3"""
+    destination.write_text("".join(f"{seg_id}\n" for seg_id in segments["seg_id"]))
+
+
 def create_partitions(
     full_dir: Path,
     segment_csv: Path,
     groupby_key: GroupbyKey = GroupbyKey.SEGMENT,
     do_symlink: bool = True,
     seed: int = 0,
+    split_factors: Optional[list[int]] = None,
+    lpt: bool = False,
+    manifest: bool = False,
 ) -> None:
-    """Split the training set into subsets of approximately the same length"""
+    """Split the training set into subsets of approximately the same length.
+
+    With `manifest`, each subset is written as a list of segments instead of a tree of symlinks.
+    """
     full_dir = full_dir.resolve()
+    split_factors = SPLIT_FACTORS if split_factors is None else split_factors
     output_dir, csv_dir = full_dir.parent / groupby_key, segment_csv.parent / groupby_key
     output_dir.mkdir(exist_ok=True)
     csv_dir.mkdir(exist_ok=True)
 
     segments = pd.read_csv(segment_csv)
     segments["duration"] = segments["end"] - segments["start"]
-    partitions = [segments.sample(frac=1, random_state=seed)]
+    segments = segments.sample(frac=1, random_state=seed)
+    codes, _ = pd.factorize(segments[groupby_key], sort=True)
+    # Summed as the baseline did, with the compensated sum of groupby over the shuffled rows
+    durations = segments.groupby(groupby_key, sort=True)["duration"].sum().to_numpy()
+    levels = hierarchical_split(durations, split_factors, lpt)
 
-    with tqdm(total=len(SPLIT_FACTORS)) as pbar:
+    report = {}
+    with tqdm(total=len(split_factors)) as pbar:
         split = 1
-        for split_factor in SPLIT_FACTORS:
+        for split_factor, bins in zip(split_factors, levels):
             split *= split_factor
             pbar.set_description(f"Split in {split} by {groupby_key}.")
-            partitions = greedy_split(partitions, split_factor, groupby_key)
+            split_id = bins[codes]
+            order = np.argsort(split_id, kind="stable")
+            partitions = segments.iloc[order].assign(split_id=split_id[order])
             (output_dir / str(split)).mkdir(exist_ok=True)
-            for idx, partition in enumerate(partitions):
-                partition["split_id"] = idx
-                if do_symlink:
-                    symlink_data(partition, full_dir, output_dir / f"{split}/{idx}", groupby_key)
-            pd.concat(partitions).to_csv(csv_dir / f"{split}.csv", index=False)
+            if manifest or do_symlink:
+                indices = partitions.groupby("split_id").indices
+                for idx in range(split):
+                    partition = partitions.iloc[indices.get(idx, [])]
+                    if manifest:
+                        write_manifest(partition, output_dir / f"{split}/{idx}.txt")
+                    else:
+                        symlink_data(partition, full_dir, output_dir / f"{split}/{idx}", groupby_key)
+            partitions.to_csv(csv_dir / f"{split}.csv", index=False)
+            report[split] = balance_report(durations, bins, split)
+            tqdm.write(f"Split in {split}: imbalance of {report[split]['imbalance']:.2%} between bins.")
             pbar.update()
+    with open(csv_dir / "balance.json", "w") as file:
+        json.dump(report, file, indent=2)
+
+
+def _materialize(partition: pd.DataFrame, full_dir: Path, destination: Path, groupby_key: GroupbyKey) -> None:
+    """Symlink a partition in a temporary directory, renamed into place once complete"""
+    tmp = Path(tempfile.mkdtemp(dir=destination.parent, prefix=f".{destination.name}-"))
+    try:
+        symlink_data(partition, full_dir, tmp / destination.name, groupby_key)
+        os.rename(tmp / destination.name, destination)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def materialize_partitions(
+    full_dir: Path,
+    segment_csv: Path,
+    groupby_key: GroupbyKey = GroupbyKey.SEGMENT,
+    splits: Optional[list[int]] = None,
+    n_jobs: int = -1,
+) -> None:
+    """Build the symlink trees of partitions created in manifest mode, in parallel
+
+    Each partition appears only once complete, so an interrupted run is resumed by running it again.
+    """
+    full_dir = full_dir.resolve()
+    output_dir, csv_dir = full_dir.parent / groupby_key, segment_csv.parent / groupby_key
+    if splits is None:
+        splits = sorted(int(path.stem) for path in csv_dir.glob("*.csv"))
+    jobs = []
+    for split in splits:
+        (output_dir / str(split)).mkdir(parents=True, exist_ok=True)
+        for idx, partition in pd.read_csv(csv_dir / f"{split}.csv").groupby("split_id"):
+            destination = output_dir / f"{split}/{idx}"
+            for stale in destination.parent.glob(f".{idx}-*"):
+                shutil.rmtree(stale)  # Left by an interrupted run
+            if not destination.exists():
+                jobs.append((partition, destination))
+    launcher = Parallel(n_jobs=n_jobs, verbose=10)
+    launcher(delayed(_materialize)(partition, full_dir, destination, groupby_key) for partition, destination in jobs)
@@ -1,15 +1,20 @@
 import dataclasses
 import logging
+import os
 import subprocess
+import tempfile
+import wave
+from collections import defaultdict
 from enum import StrEnum
 from pathlib import Path
 from typing import Callable
 
+import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
 
 from plearning import CPC
-from plearning.data.partition import GroupbyKey
+from plearning.keys import GroupbyKey
 from plearning.utils import get_logger
 
 
@@ -54,46 +59,218 @@ class SoxProcessor:
         return process.stdout, process.stderr
 
 
-def _make_worker(processor: SoxProcessor, logger: logging.Logger) -> Callable:
-    def worker(inp: Path, output: Path) -> None:
-        stdout, stderr = processor(inp, output)
+@dataclasses.dataclass(frozen=True)
+class Journal:
+    """Append-only record of the outputs that were fully written, relative to `root`"""
+
+    root: Path
+    name: str = "journal.txt"
+
+    @property
+    def path(self) -> Path:
+        return self.root / self.name
+
+    def completed(self) -> set[str]:
+        if not self.path.is_file():
+            return set()
+        return set(self.path.read_text().splitlines())
+
+    def record(self, *outputs: str | Path) -> None:
+        lines = "".join(f"{Path(output).relative_to(self.root)}\n" for output in outputs)
+        with open(self.path, "a") as file:
+            file.write(lines)
+
+
+def plan_outputs(journal: Journal, outputs: pd.Series) -> np.ndarray:
+    """Mask of the outputs (relative to the journal root) that must be built.
+
+    Output directories are created in bulk and listed once each. Outputs that exist but are missing from the journal
+    were interrupted and are rebuilt. Without journal, existing outputs are trusted and recorded.
+    """
+    directories = outputs.str.rpartition("/")[0].unique()
+    existing: set[str] = set()
+    for directory in directories:
+        (journal.root / directory).mkdir(parents=True, exist_ok=True)
+        existing.update(str(Path(directory) / name) for name in os.listdir(journal.root / directory))
+    if journal.path.is_file():
+        done = journal.completed() & existing
+    else:
+        done = existing & set(outputs)
+        journal.record(*sorted(journal.root / output for output in done))
+    return ~outputs.isin(done).to_numpy()
+
+
+class SegmentEngine(StrEnum):
+    SOX = "sox"
+    TORCHAUDIO = "torchaudio"
+
+
+@dataclasses.dataclass
+class TalkSegmenter:
+    """Decode a source file once and write all its segments, remixed and resampled like `SoxProcessor`
+
+    The output is close to, but not bit-exact with, the sox output: the windowed-sinc resampler uses the Kaiser
+    parameters of high quality resamplers, not the sox filter, sox dithers when reducing the precision, and `-G` lowers
+    the gain where we clip. `plearning data compare-engines` measures the difference on a talk.
+    """
+
+    sample_rate: int = 16_000
+    extension: str = CPC.file_extension
+    channels: Channels = Channels.IGNORE
+    precision: int = 16
+
+    def __post_init__(self) -> None:
+        assert self.channels in ["left", "right", "mono", "ignore"]
+        if not self.extension.startswith(".") or self.extension == ".":
+            raise ValueError("extension must start with a dot")
+
+    def __call__(
+        self, inp: str | Path, segments: list[tuple[str, float, float]], journal: Journal | None = None
+    ) -> None:
+        try:
+            import torchaudio
+        except ImportError as error:
+            raise ImportError("You must install torchaudio to segment audio without sox.") from error
+
+        waveform, sample_rate = torchaudio.load(inp)
+        if self.channels == "left":
+            waveform = waveform[:1]
+        elif self.channels == "right":
+            waveform = waveform[1:2]
+        elif self.channels == "mono":
+            waveform = waveform[:2].mean(dim=0, keepdim=True)
+        if sample_rate != self.sample_rate:
+            waveform = torchaudio.functional.resample(
+                waveform,
+                sample_rate,
+                self.sample_rate,
+                lowpass_filter_width=64,
+                rolloff=0.9475937167399596,
+                resampling_method="sinc_interp_kaiser",
+                beta=14.769656459379492,
+            )
+        waveform = waveform.clamp(-1, 1)
+        for output, start, end in segments:
+            assert Path(output).suffix == self.extension
+            assert 0 <= start < end
+            first, last = round(start * self.sample_rate), round(end * self.sample_rate)
+            torchaudio.save(
+                output,
+                waveform[:, first:last],
+                self.sample_rate,
+                encoding="PCM_S",
+                bits_per_sample=self.precision,
+            )
+            if journal is not None:
+                journal.record(output)
+
+
+def _make_talk_worker(segmenter: TalkSegmenter, logger: logging.Logger, journal: Journal) -> Callable:
+    def worker(inp: str, segments: list[tuple[str, float, float]]) -> None:
+        try:
+            segmenter(inp, segments, journal)
+        except Exception as error:
+            logger.error(f"{Path(inp).name} - {error}")
+            raise
+
+    return worker
+
+
+def _make_worker(processor: SoxProcessor, logger: logging.Logger, journal: Journal) -> Callable:
+    def worker(inp: Path, output: Path, start: float | None = None, end: float | None = None) -> None:
+        stdout, stderr = processor(inp, output, start, end)
+        journal.record(output)
         if stdout:
-            logger.info(f"{inp.name} - stdout: {stdout}")
+            logger.info(f"{Path(inp).name} - stdout: {stdout}")
         if stderr:
-            logger.warning(f"{inp.name} - stderr: {stderr}")
+            logger.warning(f"{Path(inp).name} - stderr: {stderr}")
 
     return worker
 
 
 def process_audio(input_dir: Path, output_dir: Path, channels: Channels = Channels.IGNORE, n_jobs: int = -1) -> None:
-    """Process audio files with sox"""
+    """Process audio files with sox, resuming from the journal of a previous run"""
     input_dir, output_dir = input_dir.resolve(), output_dir.resolve()
     output_dir.mkdir(exist_ok=True)
-    worker = _make_worker(SoxProcessor(channels=channels), get_logger("sox", filename=output_dir / "process.log"))
+    journal = Journal(output_dir)
+    logger = get_logger("sox", filename=output_dir / "process.log")
+    worker = _make_worker(SoxProcessor(channels=channels), logger, journal)
 
     input_files = sorted([file for file in input_dir.glob("*") if file.is_file()])
-    output_files = [output_dir / file.with_suffix(CPC.file_extension).name for file in input_files]
+    outputs = pd.Series([file.with_suffix(CPC.file_extension).name for file in input_files], dtype=str)
+    to_build = plan_outputs(journal, outputs) if len(outputs) > 0 else np.zeros(0, dtype=bool)
 
     launcher = Parallel(n_jobs=n_jobs, verbose=10)
-    launcher(delayed(worker)(inp, output) for inp, output in zip(input_files, output_files))
+    launcher(
+        delayed(worker)(inp, output_dir / output)
+        for inp, output, build in zip(input_files, outputs, to_build)
+        if build
+    )
 
 
 def create_segments(
-    segments_csv: Path, input_dir: Path, output_dir: Path, channels: Channels = Channels.IGNORE, n_jobs: int = -1
+    segments_csv: Path,
+    input_dir: Path,
+    output_dir: Path,
+    channels: Channels = Channels.IGNORE,
+    n_jobs: int = -1,
+    engine: SegmentEngine = SegmentEngine.SOX,
 ) -> None:
-    """Create segments with sox"""
+    """Create segments with sox, or by decoding each source file once with torchaudio.
+
+    Completed segments are recorded in a journal, so that an interrupted run resumes where it stopped.
+    """
     segments = pd.read_csv(segments_csv)
+    output_dir = output_dir.resolve()
     output_dir.mkdir(exist_ok=True)
-    worker = _make_worker(SoxProcessor(channels=channels), get_logger("sox", filename=output_dir / "segments.log"))
+    journal = Journal(output_dir)
 
-    to_build: list[tuple[str, str, float, float]] = []
-    for _, row in segments.iterrows():
-        spk_id = str(row[GroupbyKey.SPEAKER])
-        (output_dir / spk_id).mkdir(exist_ok=True)
-        output = output_dir / spk_id / f"{row[GroupbyKey.SEGMENT]}.wav"
-        if not output.exists():
-            inp = str(input_dir / f"{row[GroupbyKey.FILE]}.wav")
-            to_build.append((inp, str(output), float(row["start"]), float(row["end"])))
+    outputs = segments[GroupbyKey.SPEAKER].astype(str) + "/" + segments[GroupbyKey.SEGMENT].astype(str) + ".wav"
+    segments = segments[plan_outputs(journal, outputs)]
+    to_build: list[tuple[str, str, float, float]] = list(
+        zip(
+            (str(input_dir / talk_id) + ".wav" for talk_id in segments[GroupbyKey.FILE].astype(str)),
+            (str(output_dir / output) for output in outputs[segments.index]),
+            segments["start"].astype(float),
+            segments["end"].astype(float),
+        )
+    )
 
     launcher = Parallel(n_jobs=n_jobs, verbose=10)
-    launcher(delayed(worker)(inp, output, start, end) for inp, output, start, end in to_build)
+    if engine == SegmentEngine.SOX:
+        logger = get_logger("sox", filename=output_dir / "segments.log")
+        worker = _make_worker(SoxProcessor(channels=channels), logger, journal)
+        launcher(delayed(worker)(inp, output, start, end) for inp, output, start, end in to_build)
+    else:
+        by_talk: dict[str, list[tuple[str, float, float]]] = defaultdict(list)
+        for inp, out, start, end in to_build:
+            by_talk[inp].append((out, start, end))
+        logger = get_logger("segments", filename=output_dir / "segments.log")
+        talk_worker = _make_talk_worker(TalkSegmenter(channels=channels), logger, journal)
+        launcher(delayed(talk_worker)(inp, talk_segments) for inp, talk_segments in by_talk.items())
+
+
+def _read_pcm(path: str | Path) -> np.ndarray:
+    with wave.open(str(path), "rb") as file:
+        assert file.getsampwidth() == 2, f"{path} is not 16-bit PCM"
+        frames = np.frombuffer(file.readframes(file.getnframes()), dtype="<i2")
+        return frames.reshape(-1, file.getnchannels()).astype(np.float64) / 2**15
+
+
+def compare_engines(
+    talk: Path, start: float, end: float, channels: Channels = Channels.IGNORE, min_snr: float = 40.0
+) -> None:
+    """Write a segment of a talk with both engines, and check that the torchaudio one is close to the sox one"""
+    assert talk.is_file(), f"{talk} is not a file"
+    with tempfile.TemporaryDirectory() as directory:
+        sox, torch = Path(directory) / f"sox{CPC.file_extension}", Path(directory) / f"torch{CPC.file_extension}"
+        SoxProcessor(channels=channels)(talk, sox, start, end)
+        TalkSegmenter(channels=channels)(talk, [(str(torch), start, end)])
+        reference, other = _read_pcm(sox), _read_pcm(torch)
+    assert reference.shape[1] == other.shape[1], "The engines wrote different numbers of channels"
+    length = min(len(reference), len(other))
+    error = reference[:length] - other[:length]
+    snr = 10 * np.log10(np.sum(reference[:length] ** 2) / max(np.sum(error**2), 1e-20))
+    print(f"{len(reference)} vs {len(other)} samples, max difference {np.abs(error).max():.2e}, SNR {snr:.1f} dB")
+    assert abs(len(reference) - len(other)) <= 1, "The engines wrote segments of different lengths"
+    assert snr >= min_snr, f"The torchaudio segment differs from the sox one: SNR {snr:.1f} dB < {min_snr} dB"
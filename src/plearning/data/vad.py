@@ -1,17 +1,159 @@
+import dataclasses
+import os
+import wave
+from enum import StrEnum
 from pathlib import Path
+from typing import Any, Iterator, Optional, Protocol
 
-from tqdm import tqdm
+import numpy as np
+import typer
+from joblib import Parallel, delayed
 
 
-def vad(wavs: Path, rttms: Path, hf_token: str, pyannote_model: str = "pyannote/voice-activity-detection") -> None:
-    """Voice Activity Detection with pyannote.audio"""
-    try:
-        from pyannote.audio import Pipeline
-    except ImportError:
-        print("Cannot run VAD: pyannote.audio is not installed")
+class VADBackend(StrEnum):
+    ENERGY = "energy"
+    PYANNOTE = "pyannote"
+
+
+class VoiceActivityDetector(Protocol):
+    def __call__(self, wav: Path) -> list[tuple[float, float]]:
+        """Speech regions of `wav`, as (start, end) pairs in seconds"""
+        ...
+
+
+def read_blocks(wav: Path, block_duration: float) -> Iterator[tuple[np.ndarray, int]]:
+    """Stream a PCM WAV file as mono float blocks of `block_duration` seconds, with its sample rate"""
+    with wave.open(str(wav), "rb") as file:
+        sample_rate, channels, width = file.getframerate(), file.getnchannels(), file.getsampwidth()
+        block_size = max(1, int(block_duration * sample_rate))
+        while True:
+            raw = file.readframes(block_size)
+            if not raw:
+                return
+            if width == 1:
+                samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+            elif width == 3:
+                bytes_ = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+                padded = np.zeros((len(bytes_), 4), dtype=np.uint8)
+                padded[:, 1:] = bytes_
+                samples = padded.view("<i4").ravel().astype(np.float32) / 2**31
+            else:
+                samples = np.frombuffer(raw, dtype=f"<i{width}").astype(np.float32) / 2 ** (8 * width - 1)
+            yield samples.reshape(-1, channels).mean(axis=1), sample_rate
+
+
+@dataclasses.dataclass
+class EnergyVAD:
+    """Streaming VAD on frame energy, with an adaptive noise floor and hangover smoothing"""
+
+    frame_duration: float = 0.02
+    block_duration: float = 60.0
+    margin: float = 12.0
+    min_energy: float = -60.0
+    floor_percentile: float = 10.0
+    floor_smoothing: float = 0.9
+    hangover: float = 0.3
+    min_duration: float = 0.2
+
+    def __call__(self, wav: Path) -> list[tuple[float, float]]:
+        runs: list[list[int]] = []
+        remainder = np.zeros(0, dtype=np.float32)
+        floor: Optional[float] = None
+        offset, last_active = 0, -(2**62)
+        frame_size = hangover = 0
+        for samples, sample_rate in read_blocks(wav, self.block_duration):
+            frame_size = max(1, round(self.frame_duration * sample_rate))
+            hangover = round(self.hangover / self.frame_duration)
+            samples = np.concatenate([remainder, samples])
+            num_frames = len(samples) // frame_size
+            remainder = samples[num_frames * frame_size :]
+            if num_frames == 0:
+                continue
+            frames = samples[: num_frames * frame_size].reshape(num_frames, frame_size)
+            energy = 10 * np.log10(np.mean(frames**2, axis=1) + 1e-10)
+
+            block_floor = float(np.percentile(energy, self.floor_percentile))
+            floor = (
+                block_floor
+                if floor is None
+                else self.floor_smoothing * floor + (1 - self.floor_smoothing) * block_floor
+            )
+            active = energy > max(floor + self.margin, self.min_energy)
+
+            indices = offset + np.arange(num_frames)
+            latest = np.maximum.accumulate(np.where(active, indices, last_active))
+            speech = indices - latest <= hangover
+            last_active = int(latest[-1])
+
+            edges = np.diff(np.concatenate([[0], speech.astype(np.int8), [0]]))
+            for start, end in zip(np.flatnonzero(edges == 1) + offset, np.flatnonzero(edges == -1) + offset):
+                if runs and runs[-1][1] == start:
+                    runs[-1][1] = int(end)
+                else:
+                    runs.append([int(start), int(end)])
+            offset += num_frames
+
+        frame = self.frame_duration
+        return [(start * frame, end * frame) for start, end in runs if (end - start) * frame >= self.min_duration]
+
+
+@dataclasses.dataclass
+class PyannoteVAD:
+    """VAD with a pretrained pyannote.audio pipeline, loaded on first use"""
+
+    hf_token: Optional[str] = None
+    model: str = "pyannote/voice-activity-detection"
+
+    def __post_init__(self) -> None:
+        self._pipeline: Any = None
+
+    def __call__(self, wav: Path) -> list[tuple[float, float]]:
+        if self._pipeline is None:
+            try:
+                from pyannote.audio import Pipeline
+            except ImportError as error:
+                raise ImportError("You must install pyannote.audio to run VAD with pyannote") from error
+            self._pipeline = Pipeline.from_pretrained(self.model, use_auth_token=self.hf_token)
+        annotation = self._pipeline(wav)
+        return [(segment.start, segment.end) for segment in annotation.get_timeline().support()]
+
+
+def write_rttm(regions: list[tuple[float, float]], uri: str, path: Path) -> None:
+    """Write speech regions in the RTTM format produced by pyannote.audio"""
+    lines = "".join(
+        f"SPEAKER {uri} 1 {start:.3f} {end - start:.3f} <NA> <NA> SPEECH <NA> <NA>\n" for start, end in regions
+    )
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(lines, encoding="utf-8")
+    tmp.rename(path)
+
+
+def _run_chunk(detector: VoiceActivityDetector, wavs: list[Path], rttms: Path) -> None:
+    for wav in wavs:
+        write_rttm(detector(wav), wav.stem, rttms / f"{wav.name}.rttm")
+
+
+def vad(
+    wavs: Path,
+    rttms: Path,
+    hf_token: Optional[str] = typer.Option(
+        None, "--hf-token", envvar="HUGGING_FACE_HUB_TOKEN", help="Hugging Face token, needed by the pyannote backend"
+    ),
+    pyannote_model: str = "pyannote/voice-activity-detection",
+    backend: VADBackend = VADBackend.PYANNOTE,
+    overwrite: bool = False,
+    n_jobs: int = -1,
+) -> None:
+    """Voice Activity Detection with pyannote.audio or a streaming energy detector, skipping existing RTTMs"""
     rttms.mkdir(exist_ok=True)
-    pipeline = Pipeline.from_pretrained(pyannote_model, use_auth_token=hf_token)
-    for wav in tqdm(list(wavs.rglob("*.wav")), desc="VAD with pyannote.audio"):
-        pyannote_vad = pipeline(wav)
-        with open(rttms / f"{wav.name}.rttm", "w", encoding="utf-8") as file:
-            pyannote_vad.write(file)
+    existing = set(os.listdir(rttms))
+    to_process = sorted(wav for wav in wavs.rglob("*.wav") if overwrite or f"{wav.name}.rttm" not in existing)
+    if not to_process:
+        return
+    if backend == VADBackend.PYANNOTE:
+        # A single pipeline in this process: one per worker would each load the model on the GPU
+        _run_chunk(PyannoteVAD(hf_token, pyannote_model), to_process, rttms)
+        return
+    num_chunks = min(len(to_process), 4 * (os.cpu_count() or 1))
+    launcher = Parallel(n_jobs=n_jobs, verbose=10)
+    launcher(delayed(_run_chunk)(EnergyVAD(), to_process[i::num_chunks], rttms) for i in range(num_chunks))
@@ -1,12 +1,19 @@
 """Verify data"""
+import os
+import wave
+from collections import defaultdict
 from enum import StrEnum
 from pathlib import Path
 
 import pandas as pd
+from joblib import Parallel, delayed
 
 from plearning import CPC
-from plearning.data.partition import GroupbyKey
+from plearning.keys import GroupbyKey
 from plearning.utils import get_logger
+from plearning.walk import walk
+
+MAX_LOGGED_FILES = 10
 
 
 class FolderHierarchy(StrEnum):
@@ -14,6 +21,41 @@ class FolderHierarchy(StrEnum):
     LANGUAGE = "lang_id"
 
 
+def scan_files(root: Path, n_jobs: int = -1) -> set[str]:
+    """Relative paths of all the audio files under `root`, found with a single parallel scandir pass"""
+    prefix = len(str(root.resolve())) + 1
+    return {
+        os.path.join(directory, name)[prefix:]
+        for directory, listing in walk(root, n_jobs=n_jobs).items()
+        for name in listing.files
+        if name.endswith(CPC.file_extension)
+    }
+
+
+def _read_header(path: Path) -> tuple[int, int, float]:
+    with wave.open(str(path), "rb") as file:
+        return file.getframerate(), file.getnchannels(), file.getnframes() / file.getframerate()
+
+
+def _check_headers(
+    paths: list[Path], durations: list[float], sample_rate: int, channels: int, tolerance: float
+) -> list[str]:
+    errors = []
+    for path, duration in zip(paths, durations):
+        try:
+            file_rate, file_channels, file_duration = _read_header(path)
+        except (OSError, EOFError, wave.Error) as error:
+            errors.append(f"Unreadable header for {path}: {error}")
+            continue
+        if file_rate != sample_rate:
+            errors.append(f"Invalid sample rate for {path}: {file_rate} instead of {sample_rate}")
+        if file_channels != channels:
+            errors.append(f"Invalid number of channels for {path}: {file_channels} instead of {channels}")
+        if abs(file_duration - duration) > tolerance:
+            errors.append(f"Invalid duration for {path}: {file_duration:.3f}s instead of {duration:.3f}s")
+    return errors
+
+
 def verify(
     full_dir: Path,
     csv_dir: Path,
@@ -21,31 +63,68 @@ def verify(
     hierarchy_key: FolderHierarchy = FolderHierarchy.SPEAKER,
     fraction: float = 1.0,
     seed: int = 0,
+    deep: bool = False,
+    sample_rate: int = 16_000,
+    channels: int = 1,
+    tolerance: float = 0.01,
+    n_jobs: int = -1,
 ) -> None:
-    """Verify dataset integrity"""
+    """Verify dataset integrity, and optionally the WAV headers of a fraction of the files"""
     logger = get_logger("verify")
+    full_dir = full_dir.resolve()
     train_segments = pd.read_csv(csv_dir / "train_segments.csv")
+    relative = train_segments[hierarchy_key].astype(str) + "/" + train_segments["seg_id"].astype(str)
+    relative += CPC.file_extension
 
-    def assert_directory(segments: pd.DataFrame, folder: Path) -> None:
-        num_files = len(list(folder.rglob(f"*{CPC.file_extension}")))
-        if len(segments) != num_files:
-            logger.error(f"Invalid number of files for {folder}: {num_files} instead of {len(segments)}")
-            return
-        for _, row in segments.sample(frac=fraction, random_state=seed).iterrows():
-            current_file = (folder / f"{row[hierarchy_key]}/{row.seg_id}").with_suffix(CPC.file_extension)
-            if not current_file.is_file():
-                logger.error(f"Missing file: {current_file}")
+    def report(name: str, expected: set[str], present: set[str]) -> None:
+        missing, extra = sorted(expected - present), sorted(present - expected)
+        for kind, files in [("Missing", missing), ("Extra", extra)]:
+            if files:
+                logger.error(f"{kind} files for {name}: {len(files)} of {len(expected)}")
+                for file in files[:MAX_LOGGED_FILES]:
+                    logger.error(f"{kind} file: {file}")
 
     logger.info("Checking full")
-    assert_directory(train_segments, full_dir)
+    found = scan_files(full_dir, n_jobs=n_jobs)
+    report("full", set(relative), found)
+
+    if deep:
+        logger.info("Checking WAV headers")
+        sample = train_segments[relative.isin(found)].sample(frac=fraction, random_state=seed)
+        paths = [full_dir / path for path in relative[sample.index]]
+        durations = (sample["end"] - sample["start"]).tolist()
+        chunk = max(1, len(paths) // (8 * (os.cpu_count() or 1)))
+        launcher = Parallel(n_jobs=n_jobs, verbose=10)
+        for errors in launcher(
+            delayed(_check_headers)(paths[i : i + chunk], durations[i : i + chunk], sample_rate, channels, tolerance)
+            for i in range(0, len(paths), chunk)
+        ):
+            for error in errors:
+                logger.error(error)
+
     if not (csv_dir / groupby_key).is_dir():
         return
+    partitions_dir = full_dir.parent / groupby_key
+    present: dict[str, set[str]] = defaultdict(set)
+    if partitions_dir.is_dir():
+        for file in scan_files(partitions_dir, n_jobs=n_jobs):
+            parts = file.split("/", 2)
+            if len(parts) == 3:
+                present[f"{parts[0]}/{parts[1]}"].add(file)
     for path in (csv_dir / groupby_key).glob("*.csv"):
         segments = pd.read_csv(path)
         assert len(segments) == len(train_segments)
         splits = int(path.stem)
         logger.info(f"Checking for {splits} splits")
-        assert (full_dir.parent / groupby_key / str(splits)).is_dir()
+        assert (partitions_dir / str(splits)).is_dir()
         assert len(segments.split_id.unique()) == splits
-        for split, subsegs in segments.groupby("split_id", as_index=False):
-            assert_directory(subsegs, full_dir.parent / groupby_key / f"{splits}/{split}")
+        names = f"{splits}/" + segments["split_id"].astype(str)
+        files = names + "/" + segments[hierarchy_key].astype(str) + "/" + segments["seg_id"].astype(str)
+        files += CPC.file_extension
+        for name, indices in names.groupby(names).indices.items():
+            manifest = partitions_dir / f"{name}.txt"
+            if not (partitions_dir / name).is_dir() and manifest.is_file():
+                expected = set(segments["seg_id"].iloc[indices].astype(str))
+                report(name, expected, set(manifest.read_text().splitlines()))
+            else:
+                report(name, set(files.iloc[indices]), present[name])
@@ -0,0 +1,189 @@
+"""Registry of the training and test sets, with a cached metadata index of each corpus"""
+import dataclasses
+import hashlib
+import json
+import os
+import tempfile
+import wave
+from enum import StrEnum
+from pathlib import Path
+from typing import Optional
+
+from joblib import Parallel, delayed
+
+from plearning import CPC
+from plearning.walk import index_path, walk
+
+REGISTRY_FILE = "datasets.json"
+
+DEFAULT_REGISTRY: dict[str, dict[str, dict[str, str]]] = {
+    "train": {
+        "English": {"language": "English"},
+        "Japanese": {"language": "Japanese"},
+    },
+    "test": {
+        "csj": {"path": "CSJ/test", "item": "test.item", "language": "Japanese"},
+        "gpj": {"path": "GPJ/test", "item": "test.item", "language": "Japanese"},
+        "buc": {"path": "BUC/test", "item": "test.item", "language": "English"},
+        "wsj": {"path": "WSJ/test", "item": "test.item", "language": "English"},
+    },
+}
+
+
+class DatasetKind(StrEnum):
+    TRAIN = "train"
+    TEST = "test"
+
+
+@dataclasses.dataclass(frozen=True)
+class Dataset:
+    name: str
+    kind: DatasetKind
+    path: Optional[str] = None
+    language: Optional[str] = None
+    item: Optional[str] = None
+
+
+@dataclasses.dataclass
+class DatasetMetadata:
+    stamp: str
+    files: int
+    duration: float
+    speakers: int
+    phones: list[str]
+
+
+def _durations(paths: list[str]) -> list[float]:
+    durations = []
+    for path in paths:
+        with wave.open(path, "rb") as file:
+            durations.append(file.getnframes() / file.getframerate())
+    return durations
+
+
+class DatasetRegistry:
+    """Datasets listed in a config file, with paths checked on first use and metadata cached on disk"""
+
+    def __init__(
+        self, datasets: list[Dataset], data: Optional[Path], cache: Optional[Path], file_extension: str = ".wav"
+    ) -> None:
+        self.data, self.cache, self.file_extension = data, cache, file_extension
+        self.datasets = {dataset.name: dataset for dataset in datasets}
+        self._paths: dict[str, Path] = {}
+        self._items: dict[str, Path] = {}
+
+    @classmethod
+    def from_dict(
+        cls,
+        registry: dict[str, dict[str, dict[str, str]]],
+        data: Optional[Path],
+        cache: Optional[Path],
+        file_extension: str = ".wav",
+    ) -> "DatasetRegistry":
+        datasets = [
+            Dataset(name=name, kind=DatasetKind(kind), **fields)
+            for kind in DatasetKind
+            for name, fields in registry.get(kind, {}).items()
+        ]
+        return cls(datasets, data, cache, file_extension)
+
+    @classmethod
+    def from_file(
+        cls, data: Path, cache: Path, config: Optional[Path] = None, file_extension: str = ".wav"
+    ) -> "DatasetRegistry":
+        """Registry of the config file, by default `datasets.json` in the data directory, or the default datasets"""
+        config = data / REGISTRY_FILE if config is None else config
+        registry = json.loads(config.read_text()) if config.is_file() else DEFAULT_REGISTRY
+        return cls.from_dict(registry, data, cache, file_extension)
+
+    def _directory(self, directory: Optional[Path]) -> Path:
+        if directory is None:
+            raise KeyError("Must set SCRATCH environment variable to resolve the paths of the datasets.")
+        return directory
+
+    def names(self, kind: DatasetKind) -> list[str]:
+        return [name for name, dataset in self.datasets.items() if dataset.kind == kind]
+
+    def path(self, name: str) -> Path:
+        """Directory of the audio files of a dataset"""
+        if name not in self._paths:
+            relative = self.datasets[name].path
+            assert relative is not None, f"{name} has no path in the registry"
+            path = self._directory(self.data) / relative
+            assert path.is_dir(), f"{path} is not a directory"
+            self._paths[name] = path
+        return self._paths[name]
+
+    def item(self, name: str) -> Path:
+        """Item file of a test set"""
+        if name not in self._items:
+            item = self.datasets[name].item
+            assert item is not None, f"{name} has no item file"
+            path = self.path(name) / item
+            assert path.is_file(), name
+            self._items[name] = path
+        return self._items[name]
+
+    def test_items(self) -> dict[str, Path]:
+        return {name: self.item(name) for name in self.names(DatasetKind.TEST)}
+
+    def language(self, name: str) -> Optional[str]:
+        return self.datasets[name].language
+
+    def _stamp(self, name: str, tree: dict) -> str:
+        digest = hashlib.sha1(self.file_extension.encode())
+        for directory in sorted(tree):
+            digest.update(f"{directory} {tree[directory].mtime}\n".encode())
+        if self.datasets[name].item is not None:
+            stat = self.item(name).stat()
+            digest.update(f"{stat.st_mtime_ns} {stat.st_size}".encode())
+        return digest.hexdigest()
+
+    def metadata(self, name: str, n_jobs: int = -1) -> DatasetMetadata:
+        """File count, total duration, speaker count and phone inventory, recomputed when a directory changed"""
+        root = self.path(name)
+        tree = walk(root, n_jobs=n_jobs, index=index_path(root))
+        stamp = self._stamp(name, tree)
+        path = self._directory(self.cache) / "datasets" / f"{name}.json"
+        if path.is_file():
+            cached = DatasetMetadata(**json.loads(path.read_text()))
+            if cached.stamp == stamp:
+                return cached
+
+        files = sorted(
+            f"{directory}/{file}"
+            for directory, listing in tree.items()
+            for file in listing.files
+            if file.endswith(self.file_extension)
+        )
+        size = max(1, len(files) // 256)
+        durations = Parallel(n_jobs=n_jobs)(
+            delayed(_durations)(files[i : i + size]) for i in range(0, len(files), size)
+        )
+        speakers, phones = len({Path(file).parent for file in files}), []
+        if self.datasets[name].item is not None:
+            from plearning.utils import read_item  # pandas is only needed for the test sets
+
+            item = read_item(self.item(name))
+            speakers, phones = item["speaker_id"].nunique(), sorted(map(str, item["#phone"].unique()))
+        metadata = DatasetMetadata(stamp, len(files), sum(map(sum, durations)), int(speakers), phones)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=path.parent, suffix=".tmp", delete=False) as file:
+            json.dump(dataclasses.asdict(metadata), file)
+        os.replace(file.name, path)
+        return metadata
+
+
+def dataset_info(n_jobs: int = -1) -> None:
+    """Print the registered datasets with their number of files, duration, speakers and phones"""
+    registry = CPC.datasets
+    print(f"{'name':<12}{'kind':<8}{'language':<12}{'files':>10}{'hours':>10}{'speakers':>10}{'phones':>8}")
+    for name, dataset in registry.datasets.items():
+        if dataset.path is None:
+            print(f"{name:<12}{dataset.kind:<8}{dataset.language or '':<12}{'no path in the registry':>48}")
+            continue
+        metadata = registry.metadata(name, n_jobs)
+        print(
+            f"{name:<12}{dataset.kind:<8}{dataset.language or '':<12}{metadata.files:>10}"
+            f"{metadata.duration / 3600:>10.1f}{metadata.speakers:>10}{len(metadata.phones):>8}"
+        )
@@ -1,11 +1,15 @@
+import csv
 import dataclasses
-import sys
+from collections import defaultdict
 from pathlib import Path
-from typing import Callable, Generator, Union
+from typing import Callable, Generator, Optional, Union
 
-import pandas as pd
+import typer
 
 from plearning import CPC
+from plearning.cache import ResultCache, write_pending
+from plearning.store import STORE_META, FeatureStore
+from plearning.walk import walk
 
 
 def get_last_parts(path: Path, depth: int) -> Path:
@@ -13,17 +17,50 @@ def get_last_parts(path: Path, depth: int) -> Path:
 
 
 def get_last_dirs(path: Path) -> list[Path]:
-    assert sys.version_info >= (3, 11), "Need python 3.11 for the following pathlib method"
-    subdirs = list(path.glob("*/"))
-    if len(subdirs) == 0:
+    """Leaf directories under `path`, feature stores being leaves"""
+    if FeatureStore.is_store(path):
         return [path]
-    return sum([get_last_dirs(subdir) for subdir in subdirs], [])
+    tree = walk(path, follow_symlinks=True)
+    return sorted(
+        Path(directory) for directory, listing in tree.items() if not listing.subdirs or STORE_META in listing.files
+    )
+
+
+def pre_computed_command(features: Path) -> str:
+    if FeatureStore.is_store(features):
+        return CPC.evaluation_native()
+    return CPC.evaluation_from_pre_computed()
+
+
+def pre_computed_job(features: Path, eval_abx: Optional[Path], **kwargs: Union[Path, str]) -> str:
+    """Evaluation of pre-computed features, natively for feature stores and with eval_abx for .pt files"""
+    if not FeatureStore.is_store(features):
+        assert eval_abx is not None, f"--eval-abx is needed to evaluate {features}, which is not a feature store"
+    return pre_computed_command(features).format(eval_abx=eval_abx, dataset=features, **kwargs)
 
 
 @dataclasses.dataclass
 class Evaluator:
     cmd_func: Callable[..., str]
     generator: Callable[[Path], Generator[tuple[Path, Path], None, None]]
+    template_func: Callable[[Path], str]
+    packed_func: Optional[Callable[..., str]] = None
+    _cache: Optional[ResultCache] = dataclasses.field(default=None, init=False)
+    _pending: dict[str, list[tuple[str, str]]] = dataclasses.field(default_factory=dict, init=False)
+
+    def _is_done(self, cmd: str, checkpoint: Path, item: Path, mode: str, out: Path, template: str) -> bool:
+        done = all([(out / file).is_file() for file in CPC.evaluation_files])
+        if self._cache is None or not checkpoint.exists():
+            return done
+        key = self._cache.key(checkpoint, item, mode, template)
+        if done:
+            self._cache.store(key, out)
+        elif key in self._cache:
+            self._cache.restore(key, out, checkpoint, item)
+            done = True
+        else:
+            self._pending.setdefault(cmd.strip(), []).append((key, str(out)))
+        return done
 
     def _make_jobs(self, root: Path, item: Path) -> list[tuple[str, bool]]:
         assert item.is_file()
@@ -32,30 +69,65 @@ class Evaluator:
             out_checkpoint.mkdir(parents=True, exist_ok=True)
             for mode in ["within", "across"]:
                 cmd = self.cmd_func(checkpoint=checkpoint, item=item, mode=mode, out=out_checkpoint / mode)
-                if all([(out_checkpoint / mode / file).is_file() for file in CPC.evaluation_files]):
-                    cmds_to_run.append((cmd, False))
-                else:
-                    cmds_to_run.append((cmd, True))
+                template = self.template_func(checkpoint)
+                done = self._is_done(cmd, checkpoint, item, mode, out_checkpoint / mode, template)
+                cmds_to_run.append((cmd, not done))
         return cmds_to_run
 
-    def __call__(self, output: Path) -> None:
+    def _make_packed_jobs(self, output: Path) -> list[tuple[str, bool]]:
+        assert self.packed_func is not None
+        output.mkdir(parents=True, exist_ok=True)
+        relatives: dict[Path, set[Path]] = defaultdict(set)
+        for test, item in CPC.test_items.items():
+            assert item.is_file()
+            for checkpoint, out_checkpoint in self.generator(output / test):
+                relatives[checkpoint].add(out_checkpoint.relative_to(output / test))
+        cmds_to_run = []
+        for checkpoint, relative_set in relatives.items():
+            assert len(relative_set) == 1, f"{checkpoint} has different outputs across test sets"
+            relative = relative_set.pop()
+            cmd = self.packed_func(checkpoint=checkpoint, output=output, relative=relative)
+            done = [
+                self._is_done(cmd, checkpoint, item, mode, output / test / relative / mode, CPC.evaluation_packed())
+                for test, item in CPC.test_items.items()
+                for mode in ["within", "across"]
+            ]
+            cmds_to_run.append((cmd, not all(done)))
+        return cmds_to_run
+
+    def __call__(self, output: Path, packed: bool = False, cache: bool = True) -> None:
         output = output.resolve()
-        cmds: list[tuple[str, bool]] = sum(
-            [self._make_jobs(output / test, item) for (test, item) in CPC.test_items.items()], []
-        )
+        self._cache = ResultCache() if cache else None
+        cmds: list[tuple[str, bool]]
+        if packed:
+            cmds = self._make_packed_jobs(output)
+        else:
+            cmds = sum([self._make_jobs(output / test, item) for (test, item) in CPC.test_items.items()], [])
+        if self._cache is not None:
+            self._cache.save()
+            write_pending(output, self._cache, self._pending)
         (output / "cmd.sh").write_text("\n".join([cmd for cmd, _ in cmds]) + "\n")
         (output / "to_run.sh").write_text("\n".join([cmd for cmd, to_run in cmds if to_run]) + "\n")
 
 
-def evaluate_cpc_best_epochs(eval_abx: Path, output: Path, best_epochs: Path, hierarchy_depth: int = 1) -> None:
-    """Create jobs to evaluate all models given their best epoch on the validation set"""
-    eval_abx = eval_abx.resolve()
-    assert eval_abx.is_file()
+def evaluate_cpc_best_epochs(
+    output: Path,
+    best_epochs: Path,
+    eval_abx: Optional[Path] = typer.Option(None, "--eval-abx", help="CPC3 eval_abx script, required unless packed"),
+    hierarchy_depth: int = 1,
+    packed: bool = False,
+    cache: bool = True,
+) -> None:
+    """Create jobs to evaluate all models given their best epoch on the validation set, one per checkpoint if packed"""
+    if not packed:
+        assert eval_abx is not None and eval_abx.is_file(), "--eval-abx must be the eval_abx script unless --packed"
+        eval_abx = eval_abx.resolve()
     assert hierarchy_depth >= 1
 
     def generator(out: Path) -> Generator[tuple[Path, Path], None, None]:
-        epochs = pd.read_csv(best_epochs.resolve()).set_index("model")["epoch"]
-        for model, epoch in epochs.items():
+        with open(best_epochs.resolve(), newline="") as file:
+            epochs = [(row["model"], int(row["epoch"])) for row in csv.DictReader(file)]
+        for model, epoch in epochs:
             checkpoint = Path(model) / f"checkpoint_{epoch}.pt"
             out_checkpoint = out / get_last_parts(checkpoint, hierarchy_depth).with_suffix("")
             yield checkpoint, out_checkpoint
@@ -63,14 +135,25 @@ def evaluate_cpc_best_epochs(eval_abx: Path, output: Path, best_epochs: Path, hi
     def cmd_func(**kwargs: Union[Path, str]) -> str:
         return CPC.evaluation().format(eval_abx=eval_abx, dataset=Path(kwargs["item"]).parent, **kwargs)
 
-    Evaluator(cmd_func, generator)(output)
+    def packed_func(**kwargs: Union[Path, str]) -> str:
+        return CPC.evaluation_packed().format(**kwargs)
+
+    Evaluator(cmd_func, generator, lambda _: CPC.evaluation(), packed_func)(output, packed, cache)
 
 
-def evaluate_cpc_pre_computed(eval_abx: Path, output: Path, features: Path) -> None:
-    """Create jobs to evaluate pre-computed CPC features"""
-    eval_abx = eval_abx.resolve()
+def evaluate_cpc_pre_computed(
+    output: Path,
+    features: Path,
+    eval_abx: Optional[Path] = typer.Option(
+        None, "--eval-abx", help="CPC3 eval_abx script, required unless the features are feature stores"
+    ),
+    cache: bool = True,
+) -> None:
+    """Create jobs to evaluate pre-computed CPC features, stored as .pt files or feature stores"""
+    if eval_abx is not None:
+        assert eval_abx.is_file(), f"{eval_abx} is not the eval_abx script"
+        eval_abx = eval_abx.resolve()
     features = features.resolve()
-    assert eval_abx.is_file()
     assert features.is_dir()
 
     def generator(out: Path) -> Generator[tuple[Path, Path], None, None]:
@@ -79,22 +162,30 @@ def evaluate_cpc_pre_computed(eval_abx: Path, output: Path, features: Path) -> N
             yield feats, out / last_part
 
     def cmd_func(**kwargs: Union[Path, str]) -> str:
-        return CPC.evaluation_from_pre_computed().format(eval_abx=eval_abx, dataset=kwargs["checkpoint"], **kwargs)
-
-    Evaluator(cmd_func, generator)(output)
-
-
-def evaluate_mfcc(eval_abx: Path, output: Path, mfcc: Path) -> None:
-    """Create jobs to evaluate pre-computed MFCC"""
-    eval_abx = eval_abx.resolve()
+        return pre_computed_job(Path(kwargs["checkpoint"]), eval_abx, **kwargs)
+
+    Evaluator(cmd_func, generator, pre_computed_command)(output, cache=cache)
+
+
+def evaluate_mfcc(
+    output: Path,
+    mfcc: Path,
+    eval_abx: Optional[Path] = typer.Option(
+        None, "--eval-abx", help="CPC3 eval_abx script, required unless the features are feature stores"
+    ),
+    cache: bool = True,
+) -> None:
+    """Create jobs to evaluate pre-computed MFCC, stored as .pt files or feature stores"""
+    if eval_abx is not None:
+        assert eval_abx.is_file(), f"{eval_abx} is not the eval_abx script"
+        eval_abx = eval_abx.resolve()
     mfcc = mfcc.resolve()
-    assert eval_abx.is_file()
     assert mfcc.is_dir()
 
     def generator(out: Path) -> Generator[tuple[Path, Path], None, None]:
         yield mfcc / out.stem, out
 
     def cmd_func(**kwargs: Union[Path, str]) -> str:
-        return CPC.evaluation_from_pre_computed().format(eval_abx=eval_abx, dataset=kwargs["checkpoint"], **kwargs)
+        return pre_computed_job(Path(kwargs["checkpoint"]), eval_abx, **kwargs)
 
-    Evaluator(cmd_func, generator)(output)
+    Evaluator(cmd_func, generator, pre_computed_command)(output, cache=cache)
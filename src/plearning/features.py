@@ -0,0 +1,63 @@
+"""Features of audio files computed with a CPC3 checkpoint"""
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+from plearning import CPC
+
+
+def load_feature_function(
+    path_checkpoint: str | Path,
+    get_encoded: bool = False,
+    from_centroid: Optional[str] = None,
+    is_untrained: bool = False,
+) -> Callable[[str], np.ndarray]:
+    """Load a CPC3 model once, and return a function computing the features of an audio file"""
+    try:
+        import torch
+    except ImportError as error:
+        raise ImportError("You must install pytorch to compute features from a checkpoint") from error
+
+    try:
+        from cpc.clustering.clustering import loadClusterModule
+        from cpc.feature_loader import FeatureModule, buildFeature, loadModel
+    except ImportError as error:
+        raise ImportError("You must install CPC3 to compute features from a checkpoint") from error
+
+    model = loadModel([str(path_checkpoint)], loadStateDict=not is_untrained)[0]
+    model.gAR.keepHidden = True
+    feature_maker = FeatureModule(model, get_encoded).cuda().eval()
+
+    def base_features(x: str) -> torch.Tensor:
+        return buildFeature(feature_maker, x, seqNorm=CPC.seq_norm, strict=CPC.strict, maxSizeSeq=CPC.max_size_seq)
+
+    if from_centroid is not None:
+        cluster_module = loadClusterModule(from_centroid)
+
+        def feature_function(x: str) -> torch.Tensor:
+            c_feature = base_features(x)
+            dist_clusters = cluster_module(c_feature)
+            q_feature = torch.argmin(dist_clusters, dim=-1)
+            return cluster_module.Ck[:, q_feature.squeeze()]
+
+    else:
+        feature_function = base_features
+
+    def to_numpy(x: str) -> np.ndarray:
+        feature = feature_function(x).detach().cpu()
+        return feature.reshape(-1, feature.shape[-1]).numpy()
+
+    return to_numpy
+
+
+def extract_features(
+    feature_function: Callable[[str], np.ndarray], item: pd.DataFrame, path_dataset: str | Path
+) -> dict[str, np.ndarray]:
+    """Features of every file of an item table, found in `path_dataset`"""
+    paths = {path.stem: path for path in Path(path_dataset).rglob(f"*{CPC.file_extension}")}
+    missing = set(item["seg_id"]) - set(paths)
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} files not found in {path_dataset}")
+    return {seg_id: feature_function(str(paths[seg_id])) for seg_id in item["seg_id"].unique()}
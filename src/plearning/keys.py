@@ -0,0 +1,8 @@
+"""Keys grouping the segments of a dataset when splitting it"""
+from enum import StrEnum
+
+
+class GroupbyKey(StrEnum):
+    SEGMENT = "seg_id"
+    FILE = "talk_id"
+    SPEAKER = "speaker_id"
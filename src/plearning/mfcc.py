@@ -1,26 +1,109 @@
+import wave
 from pathlib import Path
+from typing import Any
 
-from tqdm import tqdm
+from joblib import Parallel, delayed
 
 from plearning import CPC
 
 
-def compute_mfcc(dest: Path, n_mfcc: int = 39, n_fft: int = 321) -> None:
-    """Compute MFCC on all test sets using torchaudio"""
+def _num_frames(file: Path) -> int:
+    """Number of samples per channel of a WAV file, read from its header"""
+    with wave.open(str(file), "rb") as audio:
+        return audio.getnframes()
+
+
+def _is_valid(output: Path, num_frames: int, n_mfcc: int) -> bool:
+    import torch
+
+    if not output.is_file():
+        return False
     try:
-        import torch
-        import torchaudio
+        features = torch.load(output, map_location="cpu")
+    except Exception:
+        return False
+    return tuple(features.shape) == (1, num_frames, n_mfcc)
+
+
+def batched_mfcc(mfcc: Any, waveforms: list[Any]) -> list[Any]:
+    """MFCC of each waveform with a single transform call, equal to `mfcc(waveform).permute(0, 2, 1)` of each one"""
+    import torch
+
+    n_fft, hop_length = mfcc.MelSpectrogram.spectrogram.n_fft, mfcc.MelSpectrogram.spectrogram.hop_length
+    pad = n_fft // 2
+    # Reflect-pad each signal as the centered STFT does, so that the frames kept are the same as without batching
+    padded = [torch.nn.functional.pad(x[None], (0, min(pad, x.shape[-1] - 1)), mode="reflect")[0] for x in waveforms]
+    length = max(x.shape[-1] for x in padded)
+    batch = torch.stack([torch.nn.functional.pad(x, (0, length - x.shape[-1])) for x in padded])
+    features = []
+    with torch.inference_mode():
+        mel = mfcc.MelSpectrogram(batch)
+        for idx, x in enumerate(waveforms):
+            # Convert to dB per file: the top_db threshold depends on the maximum of each spectrogram
+            num_frames = 1 + (x.shape[-1] + 2 * pad - n_fft) // hop_length
+            mel_db = mfcc.amplitude_to_DB(mel[idx, :, :, :num_frames])
+            features.append(torch.matmul(mel_db.transpose(-1, -2), mfcc.dct_mat).clone())
+    return features
+
+
+def _mfcc_batch(files: list[tuple[Path, Path, int]], n_mfcc: int, n_fft: int, n_threads: int, overwrite: bool) -> int:
+    """Compute the MFCC of a batch of files of similar lengths with a single transform call"""
+    import torch
+    import torchaudio
+
+    torch.set_num_threads(n_threads)
+    mfcc = torchaudio.transforms.MFCC(n_mfcc=n_mfcc, melkwargs={"n_fft": n_fft})
+    hop_length = mfcc.MelSpectrogram.spectrogram.hop_length
+
+    def output_frames(num_frames: int) -> int:
+        return 1 + (num_frames + 2 * (n_fft // 2) - n_fft) // hop_length
+
+    todo = [
+        (file, out, num_frames)
+        for file, out, num_frames in files
+        if overwrite or not _is_valid(out, output_frames(num_frames), n_mfcc)
+    ]
+    if not todo:
+        return 0
+
+    features = batched_mfcc(mfcc, [torchaudio.load(file)[0] for file, _, _ in todo])
+    for (_, out, _), y in zip(todo, features):
+        assert len(y.shape) == 3
+        assert y.shape[0] == 1
+        assert y.shape[2] == n_mfcc
+        tmp = out.with_suffix(".tmp")
+        torch.save(y, tmp)
+        tmp.rename(out)
+    return len(todo)
+
+
+def compute_mfcc(
+    dest: Path,
+    n_mfcc: int = 39,
+    n_fft: int = 321,
+    n_jobs: int = -1,
+    n_threads: int = 1,
+    batch_size: int = 64,
+    overwrite: bool = False,
+) -> None:
+    """Compute MFCC on all test sets using torchaudio, in parallel batches of files of similar lengths"""
+    try:
+        import torch  # noqa: F401
+        import torchaudio  # noqa: F401
     except ImportError as error:
         raise ImportError("You must install pytorch and torchaudio to build MFCC features.") from error
 
-    mfcc = torchaudio.transforms.MFCC(n_mfcc=n_mfcc, melkwargs={"n_fft": n_fft})
+    dest = dest.resolve()
+    launcher = Parallel(n_jobs=n_jobs, verbose=10)
     for test, item in CPC.test_items.items():
         assert item.is_file()
-        for file in tqdm(list(item.parent.rglob(CPC.file_extension)), desc=test):
-            out = (dest.resolve() / test / file.name).with_suffix(".pt")
-            x, _ = torchaudio.load(file)
-            y = mfcc(x).permute(0, 2, 1)
-            assert len(y.shape) == 3
-            assert y.shape[0] == 1
-            assert y.shape[2] == n_mfcc
-            torch.save(y, out)
+        (dest / test).mkdir(parents=True, exist_ok=True)
+        files = sorted(item.parent.rglob(f"*{CPC.file_extension}"))
+        lengths = launcher(delayed(_num_frames)(file) for file in files)
+        jobs = sorted(
+            [(file, (dest / test / file.name).with_suffix(".pt"), length) for file, length in zip(files, lengths)],
+            key=lambda job: job[2],
+        )
+        batches = [jobs[start : start + batch_size] for start in range(0, len(jobs), batch_size)]
+        done = launcher(delayed(_mfcc_batch)(batch, n_mfcc, n_fft, n_threads, overwrite) for batch in batches)
+        print(f"{test}: {sum(done)} files computed, {len(jobs) - sum(done)} already valid")
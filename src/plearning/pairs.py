@@ -1,31 +1,60 @@
-import itertools
 import pickle
-from collections import namedtuple
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import typer
+from joblib import Parallel, delayed
 
+from plearning.walk import find_files
 
-def abx_pairs(root: Path) -> None:
-    """Compute ABX errors for every pair for each experiment found"""
-    Score = namedtuple("Score", ["first_phone", "second_phone", "mode", "score"])
-    for extras_path in root.resolve().rglob("extras.pkl"):
-        if (extras_path.parent / "ABX_pairs.csv").exists():
+
+def pairs_from_extras(extras: dict) -> pd.DataFrame:
+    """ABX error of every ordered pair of phones, for each mode available"""
+    phone_match = extras["phone_match"]
+    phones = np.array(list(phone_match.keys()), dtype=object)
+    indices = np.array(list(phone_match.values()))
+    first, second = np.repeat(np.arange(len(phones)), len(phones)), np.tile(np.arange(len(phones)), len(phones))
+    first, second = first[first != second], second[first != second]
+
+    df = []
+    for mode in ["within", "across"]:
+        if f"phone_confusion_{mode}" not in extras:
             continue
-        with open(extras_path, "rb") as file:
-            extras = pickle.load(file)
-        phone_match = extras["phone_match"]
-
-        df = []
-        for mode in ["within", "across"]:
-            if f"phone_confusion_{mode}" not in extras:
-                continue
-            phone_confusion = extras[f"phone_confusion_{mode}"]
-            divisor_speaker = extras[f"divisor_speaker_{mode}"]
-            for first_phone, second_phone in itertools.permutations(phone_match, 2):
-                div_spk = divisor_speaker[phone_match[first_phone], phone_match[second_phone]]
-                if div_spk == 0:
-                    continue
-                score = phone_confusion[phone_match[first_phone], phone_match[second_phone]].item()
-                df.append(Score(first_phone, second_phone, mode, score))
-        pd.DataFrame(df).to_csv(extras_path.parent / "ABX_pairs.csv", index=False)
+        phone_confusion = np.asarray(extras[f"phone_confusion_{mode}"])[indices[first], indices[second]]
+        divisor_speaker = np.asarray(extras[f"divisor_speaker_{mode}"])[indices[first], indices[second]]
+        valid = divisor_speaker != 0
+        df.append(
+            pd.DataFrame(
+                {
+                    "first_phone": phones[first[valid]],
+                    "second_phone": phones[second[valid]],
+                    "mode": mode,
+                    "score": phone_confusion[valid],
+                }
+            )
+        )
+    if not df:
+        return pd.DataFrame(columns=["first_phone", "second_phone", "mode", "score"])
+    return pd.concat(df, ignore_index=True)
+
+
+def _write_pairs(extras_path: Path) -> None:
+    with open(extras_path, "rb") as file:
+        extras = pickle.load(file)
+    pairs_from_extras(extras).to_csv(extras_path.parent / "ABX_pairs.csv", index=False)
+
+
+def abx_pairs(
+    root: Path,
+    force: bool = typer.Option(False, "--force/--only-missing", help="Recompute existing ABX_pairs.csv"),
+    n_jobs: int = -1,
+) -> None:
+    """Compute ABX errors for every pair for each experiment found"""
+    to_process = [
+        extras_path
+        for extras_path in find_files(root, "extras.pkl", n_jobs=n_jobs)
+        if force or not (extras_path.parent / "ABX_pairs.csv").exists()
+    ]
+    launcher = Parallel(n_jobs=n_jobs, verbose=10)
+    launcher(delayed(_write_pairs)(extras_path) for extras_path in to_process)
@@ -0,0 +1,175 @@
+"""Run the jobs of a plan file (cmd.sh, to_run.sh) in a bounded local process pool"""
+import dataclasses
+import os
+import queue
+import shlex
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from joblib import Parallel, delayed
+
+from plearning import CPC
+from plearning.abx import is_evaluated
+from plearning.cache import ResultCache, read_pending
+from plearning.utils import get_logger
+
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS"]
+COMPLETED = "completed.txt"
+FAILED = "failed.sh"
+TASKSET = shutil.which("taskset")
+
+
+def job_output(cmd: str) -> Optional[Path]:
+    """Output directory of an ABX evaluation command, if it can be found"""
+    try:
+        args = shlex.split(cmd)
+    except ValueError:
+        return None
+    if "--out" in args[:-1]:
+        return Path(args[args.index("--out") + 1])
+    if args[:2] == ["plearning", "abx"] and len(args) > 4:
+        return Path(args[4])
+    return None
+
+
+def is_complete(cmd: str, completed: set[str]) -> bool:
+    """Whether a job already succeeded, given its evaluation outputs or the record of completed commands"""
+    args = cmd.split()
+    if args[:2] == ["plearning", "abx_checkpoint"] and len(args) > 4:
+        return all(is_evaluated(Path(args[3]) / test / args[4]) for test in CPC.test_items)
+    output = job_output(cmd)
+    if output is not None:
+        return all((output / file).is_file() for file in CPC.evaluation_files)
+    return cmd in completed
+
+
+@dataclasses.dataclass
+class JobResult:
+    index: int
+    cmd: str
+    returncode: int
+    attempts: int
+    seconds: float
+
+
+class Runner:
+    """Run shell commands in process groups pinned to disjoint CPU slots, with timeouts and retries"""
+
+    def __init__(
+        self,
+        log_dir: Path,
+        n_slots: int,
+        cpus_per_job: int,
+        retries: int,
+        backoff: float,
+        timeout: Optional[float],
+        cache: Optional[ResultCache] = None,
+        pending: Optional[dict[str, list[tuple[str, str]]]] = None,
+    ) -> None:
+        self.log_dir = log_dir
+        self.cache, self.pending = cache, {} if pending is None else pending
+        self.cpus_per_job, self.retries, self.backoff, self.timeout = cpus_per_job, retries, backoff, timeout
+        self.slots: queue.Queue[int] = queue.Queue()
+        for slot in range(n_slots):
+            self.slots.put(slot)
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        self.cpus = cpus if len(cpus) >= n_slots * cpus_per_job else []
+        self.env = {**os.environ, **{variable: str(cpus_per_job) for variable in THREAD_VARIABLES}}
+        self._lock = threading.Lock()
+
+    def _affinity(self, slot: int) -> Optional[set[int]]:
+        if not self.cpus:
+            return None
+        return set(self.cpus[slot * self.cpus_per_job : (slot + 1) * self.cpus_per_job])
+
+    def _attempt(self, cmd: str, slot: int, log: Path) -> int:
+        affinity = self._affinity(slot)
+        args = ["/bin/sh", "-c", cmd]
+        if affinity is not None and TASKSET is not None:
+            # Pinned before the shell starts, unlike a call to sched_setaffinity after the spawn
+            args = [TASKSET, "-c", ",".join(map(str, sorted(affinity))), *args]
+        with open(log, "a") as file:
+            file.write(f"$ {cmd}\n")
+            file.flush()
+            process = subprocess.Popen(
+                args, stdout=file, stderr=subprocess.STDOUT, env=self.env, start_new_session=True
+            )
+            if affinity is not None and TASKSET is None:
+                os.sched_setaffinity(process.pid, affinity)
+            try:
+                return process.wait(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                file.write(f"Timeout after {self.timeout}s\n")
+                return -signal.SIGKILL
+
+    def __call__(self, index: int, cmd: str) -> JobResult:
+        start = time.perf_counter()
+        log = self.log_dir / f"{index:05d}.log"
+        for attempt in range(1, self.retries + 2):
+            slot = self.slots.get()
+            try:
+                returncode = self._attempt(cmd, slot, log)
+            finally:
+                self.slots.put(slot)
+            if returncode == 0 or attempt == self.retries + 1:
+                break
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+        if returncode == 0:
+            if self.cache is not None:
+                for key, out in self.pending.get(cmd, []):
+                    self.cache.store(key, Path(out))
+            with self._lock, open(self.log_dir / COMPLETED, "a") as file:
+                file.write(f"{cmd}\n")
+        return JobResult(index, cmd, returncode, attempt, time.perf_counter() - start)
+
+
+def run_plan(
+    plan: Path,
+    n_jobs: int = -1,
+    cpus_per_job: int = 1,
+    retries: int = 2,
+    backoff: float = 10.0,
+    timeout: Optional[float] = None,
+    log_dir: Optional[Path] = None,
+    force: bool = False,
+) -> None:
+    """Run the jobs of a plan file locally, skipping the ones already complete"""
+    plan = plan.resolve()
+    assert plan.is_file(), f"{plan} is not a file"
+    log_dir = plan.with_name(f"{plan.stem}_logs") if log_dir is None else log_dir.resolve()
+    log_dir.mkdir(parents=True, exist_ok=True)
+    logger = get_logger("run")
+
+    cmds = [line.strip() for line in plan.read_text().splitlines()]
+    jobs = [(index, cmd) for index, cmd in enumerate(cmds) if cmd and not cmd.startswith("#")]
+    completed = set((log_dir / COMPLETED).read_text().splitlines()) if (log_dir / COMPLETED).is_file() else set()
+    to_run = jobs if force else [(index, cmd) for index, cmd in jobs if not is_complete(cmd, completed)]
+    logger.info(f"{len(jobs) - len(to_run)} of {len(jobs)} jobs already complete, logs in {log_dir}")
+    if not to_run:
+        return
+
+    max_slots = max(1, (os.cpu_count() or 1) // cpus_per_job)
+    n_slots = min(len(to_run), max_slots if n_jobs < 1 else n_jobs)
+    runner = Runner(log_dir, n_slots, cpus_per_job, retries, backoff, timeout, *read_pending(plan.parent))
+    # More threads than slots, so that jobs waiting to be retried do not keep the free slots idle
+    n_threads = min(len(to_run), n_slots * (retries + 1))
+    launcher = Parallel(n_jobs=n_threads, prefer="threads", return_as="generator_unordered")
+    failed: list[JobResult] = []
+    for done, result in enumerate(launcher(delayed(runner)(index, cmd) for index, cmd in to_run), start=1):
+        if result.returncode != 0:
+            failed.append(result)
+            logger.error(f"Job {result.index} failed with code {result.returncode} after {result.attempts} attempts")
+        logger.info(
+            f"[{done}/{len(to_run)}] {done - len(failed)} succeeded, {len(failed)} failed, "
+            f"{min(n_slots, len(to_run) - done)} running (job {result.index}: {result.seconds:.0f}s)"
+        )
+    (log_dir / FAILED).write_text("".join(f"{result.cmd}\n" for result in sorted(failed, key=lambda r: r.index)))
+    if failed:
+        logger.error(f"{len(failed)} jobs failed, see {log_dir / FAILED}")
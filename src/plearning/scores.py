@@ -1,51 +1,124 @@
 import json
-from collections import namedtuple
+import pickle
 from pathlib import Path
+from typing import Optional
 
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
+import typer
+from joblib import Parallel, delayed
 
 from plearning import CPC
+from plearning.walk import RESULT_PRUNE, find_files
 
+SCORE_COLUMNS = ["test", "train", "phone_pair", "split", "idx", "mode", "epoch", "score"]
+CATEGORICAL_COLUMNS = ["test", "train", "phone_pair", "mode"]
 
-def recap_scores(results: Path, output: Path, train_parent: int = 0) -> None:
-    """Recap all scores"""
-    Score = namedtuple("Score", ["test", "train", "phone_pair", "split", "idx", "mode", "epoch", "score"])
-    scores = []
-
-    for path in tqdm(list(results.resolve().rglob("ABX_args.json"))):
-        with open(path, "r") as f:
-            abx_args = json.load(f)
-        checkpoint = Path(abx_args["path_checkpoint"]).resolve()
-        mode = abx_args["mode"]
-        item_file = abx_args["path_item_file"]
-        epoch = int(checkpoint.stem.split("_")[1])
-        correct_parent = list(checkpoint.parents)[train_parent]
-        train = correct_parent.stem.split("_")[0].removeprefix("cpc-")
-        test_candidates = [test for test, item in CPC.test_items.items() if str(item) == item_file]
-        assert len(test_candidates) == 1
-        test = test_candidates[0]
-        split_str, idx_str = correct_parent.stem.split("_")[-2:]
-        if idx_str == "full":
-            split, idx = 1, 0
-        else:
-            split, idx = int(split_str), int(idx_str)
-        with open(path.parent / "ABX_scores.json", "r") as f:
-            score = float(json.load(f)[mode])
-        scores.append(Score(test, train, None, split, idx, mode, epoch, score))
-        path_pairs = path.parent / "ABX_pairs.csv"
-        if path_pairs.exists():
-            df = pd.read_csv(path_pairs)
-            df["phone_pair"] = df.apply(
-                lambda row: f"[{row.first_phone}]-[{row.second_phone}]"
-                if row.first_phone < row.second_phone
-                else f"[{row.second_phone}]-[{row.first_phone}]",
-                axis=1,
-            )
-            for phone_pair, subdf in df.groupby("phone_pair"):
-                score = subdf.score.mean()
-                scores.append(Score(test, train, phone_pair, split, idx, mode, epoch, score))
-        else:
-            print(f"Pairs do not exist for {path.parent}")
-
-    pd.DataFrame(scores).to_csv(output, index=False)
+
+def canonical_pairs(first: pd.Series, second: pd.Series) -> pd.Series:
+    """Phone pairs as '[a]-[b]' strings, with the phones in lexicographic order"""
+    first, second = first.astype(str), second.astype(str)
+    ordered = first < second
+    low, high = np.where(ordered, first, second), np.where(ordered, second, first)
+    return "[" + pd.Series(low, index=first.index) + "]-[" + pd.Series(high, index=first.index) + "]"
+
+
+def result_stamp(directory: Path) -> tuple[Optional[int], ...]:
+    stamps = []
+    for name in ["ABX_args.json", "ABX_scores.json", "ABX_pairs.csv"]:
+        path = directory / name
+        stamps.append(path.stat().st_mtime_ns if path.exists() else None)
+    return tuple(stamps)
+
+
+def read_result(directory: Path, items: dict[str, str], train_parent: int) -> pd.DataFrame:
+    """Scores of a result directory: the full score, then the mean score of each phone pair"""
+    with open(directory / "ABX_args.json", "r") as f:
+        abx_args = json.load(f)
+    checkpoint = Path(abx_args["path_checkpoint"]).resolve()
+    mode = abx_args["mode"]
+    epoch = int(checkpoint.stem.split("_")[1])
+    correct_parent = list(checkpoint.parents)[train_parent]
+    train = correct_parent.stem.split("_")[0].removeprefix("cpc-")
+    test = items[abx_args["path_item_file"]]
+    split_str, idx_str = correct_parent.stem.split("_")[-2:]
+    if idx_str == "full":
+        split, idx = 1, 0
+    else:
+        split, idx = int(split_str), int(idx_str)
+    with open(directory / "ABX_scores.json", "r") as f:
+        score = float(json.load(f)[mode])
+
+    scores = pd.DataFrame({"phone_pair": [None], "score": [score]})
+    path_pairs = directory / "ABX_pairs.csv"
+    if path_pairs.exists():
+        df = pd.read_csv(path_pairs)
+        df["phone_pair"] = canonical_pairs(df["first_phone"], df["second_phone"])
+        pairs = df.groupby("phone_pair", as_index=False, sort=True)["score"].mean()
+        scores = pd.concat([scores, pairs], ignore_index=True)
+    else:
+        print(f"Pairs do not exist for {directory}")
+    scores["test"], scores["train"], scores["split"], scores["idx"] = test, train, split, idx
+    scores["mode"], scores["epoch"] = mode, epoch
+    return scores[SCORE_COLUMNS]
+
+
+def load_scores(path: Path) -> pd.DataFrame:
+    """Read scores written as CSV, Parquet or Feather, depending on the extension of `path`"""
+    match path.suffix:
+        case ".parquet":
+            return pd.read_parquet(path)
+        case ".feather":
+            return pd.read_feather(path)
+        case _:
+            return pd.read_csv(path)
+
+
+def write_scores(scores: pd.DataFrame, output: Path) -> None:
+    """Write scores as CSV, Parquet or Feather, depending on the extension of `output`"""
+    match output.suffix:
+        case ".parquet":
+            scores.to_parquet(output, index=False)
+        case ".feather":
+            scores.reset_index(drop=True).to_feather(output)
+        case _:
+            scores.to_csv(output, index=False)
+
+
+def recap_scores(
+    results: Path,
+    output: Path,
+    train_parent: int = 0,
+    n_jobs: int = -1,
+    cache: bool = True,
+    prune: list[str] = typer.Option(RESULT_PRUNE, "--prune", help="Pattern of directory names not to descend into"),
+) -> None:
+    """Recap all scores, only reading the result directories that changed since the last run"""
+    items = {str(item): test for test, item in CPC.test_items.items()}
+    cache_path = output.with_suffix(".cache.pkl")
+    stamps: dict[str, tuple[Optional[int], ...]] = {}
+    scores = pd.DataFrame(columns=["result", *SCORE_COLUMNS])
+    if cache and cache_path.is_file():
+        with open(cache_path, "rb") as file:
+            cached = pickle.load(file)
+        if cached["train_parent"] == train_parent:
+            stamps, scores = cached["stamps"], cached["scores"]
+
+    directories = {str(path.parent): path.parent for path in find_files(results, "ABX_args.json", prune, n_jobs)}
+    current = {directory: result_stamp(path) for directory, path in directories.items()}
+    to_read = [directory for directory, stamp in current.items() if stamps.get(directory) != stamp]
+    scores = scores[scores["result"].isin(set(current) - set(to_read))]
+
+    launcher = Parallel(n_jobs=n_jobs, verbose=10)
+    new_scores = launcher(delayed(read_result)(directories[d], items, train_parent) for d in to_read)
+    for directory, df in zip(to_read, new_scores):
+        df.insert(0, "result", directory)
+    frames = [df for df in [scores, *new_scores] if len(df) > 0]
+    scores = pd.concat(frames, ignore_index=True) if frames else scores
+    scores = scores.astype({column: "category" for column in ["result", *CATEGORICAL_COLUMNS]})
+    scores = scores.astype({"split": int, "idx": int, "epoch": int, "score": float})
+
+    if cache:
+        with open(cache_path, "wb") as file:
+            pickle.dump({"train_parent": train_parent, "stamps": current, "scores": scores}, file)
+    write_scores(scores.drop(columns="result"), output)
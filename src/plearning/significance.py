@@ -0,0 +1,170 @@
+"""Bootstrap confidence intervals and native vs non-native permutation tests, for every phone pair and split at once"""
+import itertools
+import math
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from plearning import CPC
+from plearning.scores import load_scores, write_scores
+
+CONDITION = ["phone_pair", "split"]
+SIDES = ["native", "nonnative"]
+
+
+def model_scores(
+    scores: pd.DataFrame,
+    mode: str,
+    datasets: Optional[list[str]] = None,
+    languages: Optional[Mapping[str, Optional[str]]] = None,
+) -> pd.DataFrame:
+    """Native and non-native score of each model, averaged over its test sets, then over the training languages
+
+    The scores of the models of each language with the same index are averaged, as `utils.make_pairwise_score` does.
+    """
+    if languages is None:
+        languages = {name: CPC.datasets.language(name) for name in CPC.datasets.datasets}
+    scores = scores[scores["mode"] == mode]
+    if datasets is not None:
+        scores = scores[scores["test"].isin(datasets)]
+    train_language = scores["train"].map(languages)
+    scores = scores[train_language.notna()].assign(native=scores["test"].map(languages) == train_language)
+    per_model = scores.groupby([*CONDITION, "native", "train", "idx"], dropna=False, observed=True)["score"].mean()
+    per_index = per_model.groupby([*CONDITION, "native", "idx"], dropna=False, observed=True).mean()
+    return per_index.reset_index().sort_values([*CONDITION, "native", "idx"], na_position="first", ignore_index=True)
+
+
+def bootstrap_weights(size: int, n_bootstrap: int, rng: np.random.Generator) -> np.ndarray:
+    """Weights of the mean of each bootstrap sample: row b of `values @ weights.T` is the mean of resample b"""
+    samples = rng.integers(0, size, size=(n_bootstrap, size))
+    counts = np.zeros((n_bootstrap, size))
+    np.add.at(counts, (np.arange(n_bootstrap)[:, None], samples), 1)
+    return counts / size
+
+
+def permutation_weights(native: int, nonnative: int, n_permutations: int, rng: np.random.Generator) -> np.ndarray:
+    """Weights of the difference of means between the two groups of each relabelling of the pooled models
+
+    All relabellings are enumerated when there are at most `n_permutations` of them, otherwise they are drawn at random
+    and the observed labelling is added.
+    """
+    size = native + nonnative
+    if math.comb(size, native) <= n_permutations:
+        labels = np.zeros((math.comb(size, native), size), dtype=bool)
+        for row, positions in enumerate(itertools.combinations(range(size), nonnative)):
+            labels[row, list(positions)] = True
+    else:
+        observed = np.arange(size) >= native
+        labels = np.vstack([observed, rng.permuted(np.tile(observed, (n_permutations, 1)), axis=1)])
+    return np.where(labels, 1 / nonnative, -1 / native)
+
+
+def _chunk_statistics(
+    native: np.ndarray,
+    nonnative: np.ndarray,
+    weights: tuple[np.ndarray, np.ndarray, np.ndarray],
+    quantiles: list[float],
+) -> np.ndarray:
+    native_weights, nonnative_weights, permutations = weights
+    native_boot, nonnative_boot = native @ native_weights.T, nonnative @ nonnative_weights.T
+    intervals = [np.quantile(boot, quantiles, axis=1).T for boot in [native_boot, nonnative_boot]]
+    intervals.append(np.quantile(nonnative_boot - native_boot, quantiles, axis=1).T)
+
+    permuted = np.hstack([native, nonnative]) @ permutations.T
+    observed = nonnative.mean(axis=1) - native.mean(axis=1)
+    extreme = np.abs(permuted) >= np.abs(observed)[:, None] - 1e-12
+    p_value = extreme.sum(axis=1) / permutations.shape[0]
+    return np.hstack([*intervals, p_value[:, None]])
+
+
+def adjust_p_values(p_values: np.ndarray) -> np.ndarray:
+    """Benjamini-Hochberg adjusted p-values, controlling the false discovery rate over all tests; NaN are ignored"""
+    adjusted = np.full(len(p_values), np.nan)
+    tested = np.flatnonzero(~np.isnan(p_values))
+    order = tested[np.argsort(p_values[tested])]
+    ranked = p_values[order] * len(order) / np.arange(1, len(order) + 1)
+    adjusted[order] = np.minimum(1, np.minimum.accumulate(ranked[::-1])[::-1])
+    return adjusted
+
+
+def compare_native_nonnative(
+    models: pd.DataFrame,
+    n_bootstrap: int = 10_000,
+    n_permutations: int = 10_000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    memory: int = 512,
+    n_jobs: int = -1,
+) -> pd.DataFrame:
+    """Mean native and non-native scores of each phone pair and split, with bootstrap confidence intervals and the
+    p-value of a two-sided permutation test of their difference (non-native minus native)
+
+    Conditions are grouped by their number of models, so that each group shares its resampling index matrices and all
+    its resamples are one matrix product. Chunks of conditions using at most `memory` MB are processed in parallel.
+    Results only depend on `seed`, not on the chunks nor on `n_jobs`.
+    """
+    models = models.assign(condition=models.groupby(CONDITION, dropna=False, sort=False).ngroup())
+    conditions = models.drop_duplicates("condition")[CONDITION].reset_index(drop=True)
+    values, counts = {}, {}
+    for side, rows in zip(SIDES, [models["native"], ~models["native"]]):
+        subset = models[rows.to_numpy(dtype=bool)]
+        counts[side] = np.bincount(subset["condition"], minlength=len(conditions))
+        values[side] = np.full((len(conditions), max(counts[side].max(initial=0), 1)), np.nan)
+        positions = subset.groupby("condition").cumcount().to_numpy()
+        values[side][subset["condition"].to_numpy(), positions] = subset["score"].to_numpy()
+
+    alpha = 1 - confidence
+    quantiles = [alpha / 2, 1 - alpha / 2]
+    statistics = np.full((len(conditions), 7), np.nan)
+    buckets = pd.DataFrame(counts).query("native > 0 and nonnative > 0").groupby(SIDES).groups
+    tasks, targets = [], []
+    for (native, nonnative), rows in buckets.items():
+        rng = np.random.default_rng([seed, native, nonnative])
+        weights = (
+            bootstrap_weights(native, n_bootstrap, rng),
+            bootstrap_weights(nonnative, n_bootstrap, rng),
+            permutation_weights(native, nonnative, n_permutations, rng),
+        )
+        chunk = max(1, memory * 2**20 // (8 * 6 * max(n_bootstrap, weights[2].shape[0])))
+        for start in range(0, len(rows), chunk):
+            ids = rows[start : start + chunk].to_numpy()
+            chunk_values = (values["native"][ids, :native], values["nonnative"][ids, :nonnative])
+            tasks.append(delayed(_chunk_statistics)(*chunk_values, weights, quantiles))
+            targets.append(ids)
+    for ids, result in zip(targets, Parallel(n_jobs=n_jobs)(tasks)):
+        statistics[ids] = result
+
+    table = conditions.assign(native_count=counts["native"], nonnative_count=counts["nonnative"])
+    means = models.groupby(["condition", "native"])["score"].mean().unstack("native")
+    means = means.reindex(index=range(len(conditions)), columns=[True, False])
+    table["native"], table["nonnative"] = means[True].to_numpy(), means[False].to_numpy()
+    table["difference"] = table["nonnative"] - table["native"]
+    for i, name in enumerate(["native", "nonnative", "difference"]):
+        table[f"{name}_low"], table[f"{name}_high"] = statistics[:, 2 * i], statistics[:, 2 * i + 1]
+    table["p_value"] = statistics[:, 6]
+    table["p_adjusted"] = adjust_p_values(statistics[:, 6])
+    return table
+
+
+def significance(
+    scores: Path,
+    output: Path,
+    mode: str = "within",
+    n_bootstrap: int = 10_000,
+    n_permutations: int = 10_000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    memory: int = 512,
+    n_jobs: int = -1,
+) -> None:
+    """Bootstrap confidence intervals and native vs non-native permutation tests of every phone pair and split"""
+    models = model_scores(load_scores(scores), mode)
+    table = compare_native_nonnative(models, n_bootstrap, n_permutations, confidence, seed, memory, n_jobs)
+    write_scores(table, output)
+    tested = table["p_adjusted"].notna()
+    significant = (table["p_adjusted"] < 1 - confidence).sum()
+    print(f"{significant} of {tested.sum()} conditions differ significantly at FDR {1 - confidence:.2f}")
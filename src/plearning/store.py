@@ -0,0 +1,166 @@
+"""Consolidated memory-mapped storage of pre-computed features"""
+import json
+from collections.abc import Iterable, Iterator, Mapping
+from enum import StrEnum
+from pathlib import Path
+from types import TracebackType
+from typing import Optional
+
+import numpy as np
+from joblib import Parallel, delayed
+
+STORE_META = "store.json"
+STORE_INDEX = "index.npz"
+STORE_DATA = "features.bin"
+
+
+class StoreDtype(StrEnum):
+    FLOAT32 = "float32"
+    FLOAT16 = "float16"
+
+
+class FeatureStoreWriter:
+    """Append the features of each file to a single contiguous array"""
+
+    def __init__(self, path: Path, dtype: StoreDtype = StoreDtype.FLOAT32) -> None:
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.path.mkdir(parents=True, exist_ok=True)
+        (self.path / STORE_META).unlink(missing_ok=True)
+        self._file = open(self.path / STORE_DATA, "wb")
+        self._ids: list[str] = []
+        self._lengths: list[int] = []
+        self._dim: Optional[int] = None
+
+    def add(self, file_id: str, features: np.ndarray) -> None:
+        features = features.reshape(-1, features.shape[-1])
+        if self._dim is None:
+            self._dim = features.shape[1]
+        if features.shape[1] != self._dim:
+            raise ValueError(f"Invalid dimension for {file_id}: {features.shape[1]} instead of {self._dim}")
+        self._file.write(np.ascontiguousarray(features, dtype=self.dtype).tobytes())
+        self._ids.append(file_id)
+        self._lengths.append(len(features))
+
+    def close(self) -> None:
+        self._file.close()
+        lengths = np.array(self._lengths, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        np.savez(self.path / STORE_INDEX, ids=np.array(self._ids, dtype=str), offsets=offsets, lengths=lengths)
+        # The metadata is written last: a store without it is incomplete
+        meta = {"dtype": self.dtype.name, "dim": self._dim or 0, "num_frames": int(lengths.sum())}
+        with open(self.path / STORE_META, "w") as file:
+            json.dump(meta, file, indent=2)
+
+    def __enter__(self) -> "FeatureStoreWriter":
+        return self
+
+    def __exit__(
+        self, exc_type: type[BaseException] | None, exc: BaseException | None, traceback: TracebackType | None
+    ) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+
+class FeatureStore(Mapping[str, np.ndarray]):
+    """Read-only mapping from file id to a zero-copy slice of the memory-mapped features"""
+
+    def __init__(self, path: Path) -> None:
+        if not self.is_store(path):
+            raise FileNotFoundError(f"{path} is not a complete feature store")
+        self.path = path
+        with open(path / STORE_META, "r") as file:
+            meta = json.load(file)
+        with np.load(path / STORE_INDEX) as index:
+            self.offsets, self.lengths = index["offsets"], index["lengths"]
+            self._rows = {str(file_id): row for row, file_id in enumerate(index["ids"])}
+        shape = (meta["num_frames"], meta["dim"])
+        self.data: np.ndarray = np.memmap(path / STORE_DATA, dtype=meta["dtype"], mode="r", shape=shape)
+
+    @staticmethod
+    def is_store(path: Path) -> bool:
+        return (path / STORE_META).is_file()
+
+    def __getitem__(self, file_id: str) -> np.ndarray:
+        row = self._rows[file_id]
+        return self.data[self.offsets[row] : self.offsets[row] + self.lengths[row]]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._rows)
+
+    def rows(self, file_ids: Iterable[str]) -> np.ndarray:
+        """Row of each file in the index of the store"""
+        return np.array([self._rows[file_id] for file_id in file_ids], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def close(self) -> None:
+        """Drop the memory map, which is unmapped once the slices taken from it are released too"""
+        self.data = np.empty((0, self.data.shape[1]), dtype=self.data.dtype)
+        self._rows = {}
+
+    def __enter__(self) -> "FeatureStore":
+        return self
+
+    def __exit__(
+        self, exc_type: type[BaseException] | None, exc: BaseException | None, traceback: TracebackType | None
+    ) -> None:
+        self.close()
+
+
+def load_pt_features(features: Path, file_ids: list[str]) -> dict[str, np.ndarray]:
+    """Load the features of the given files from a directory of .pt tensors"""
+    try:
+        import torch
+    except ImportError as error:
+        raise ImportError("You must install pytorch to load .pt features.") from error
+
+    paths = {path.stem: path for path in features.rglob("*.pt")}
+    missing = set(file_ids) - set(paths)
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} files not found in {features}")
+    feats = {}
+    for file_id in file_ids:
+        tensor = torch.load(paths[file_id], map_location="cpu")
+        feats[file_id] = tensor.reshape(-1, tensor.shape[-1]).float().numpy()
+    return feats
+
+
+def open_features(features: Path, file_ids: list[str]) -> Mapping[str, np.ndarray]:
+    """Features of the given files, from either a feature store or a directory of .pt tensors"""
+    if FeatureStore.is_store(features):
+        store = FeatureStore(features)
+        missing = set(file_ids) - set(store)
+        if missing:
+            raise FileNotFoundError(f"{len(missing)} files not found in {features}")
+        return store
+    return load_pt_features(features, file_ids)
+
+
+def _convert_directory(source: Path, destination: Path, dtype: StoreDtype) -> int:
+    try:
+        import torch
+    except ImportError as error:
+        raise ImportError("You must install pytorch to load .pt features.") from error
+
+    paths = sorted(source.glob("*.pt"))
+    with FeatureStoreWriter(destination, dtype) as writer:
+        for path in paths:
+            writer.add(path.stem, torch.load(path, map_location="cpu").float().numpy())
+    return len(paths)
+
+
+def convert_features(
+    features: Path, output: Path, dtype: StoreDtype = StoreDtype.FLOAT32, overwrite: bool = False, n_jobs: int = -1
+) -> None:
+    """Convert every directory of .pt features into a memory-mapped feature store"""
+    features, output = features.resolve(), output.resolve()
+    assert features.is_dir()
+    sources = sorted({path.parent for path in features.rglob("*.pt")})
+    jobs = [(source, output / source.relative_to(features)) for source in sources]
+    jobs = [(source, dest) for source, dest in jobs if overwrite or not FeatureStore.is_store(dest)]
+    launcher = Parallel(n_jobs=n_jobs, verbose=10)
+    launcher(delayed(_convert_directory)(source, dest, dtype) for source, dest in jobs)
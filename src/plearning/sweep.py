@@ -0,0 +1,85 @@
+"""Evaluation of every epoch of a model, from coarse to fine where the ABX scores change"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from plearning import CPC
+from plearning.abx import checkpoint_scores
+from plearning.evaluate import get_last_parts
+from plearning.tokens import TokenIndex
+
+
+def checkpoint_epochs(model: Path, min_epoch: int, max_epoch: int) -> list[int]:
+    """Epochs of the checkpoints of a model within [min_epoch, max_epoch]"""
+    epochs = []
+    for path in model.glob("checkpoint_*.pt"):
+        suffix = path.stem.removeprefix("checkpoint_")
+        if suffix.isdigit() and min_epoch <= int(suffix) <= max_epoch:
+            epochs.append(int(suffix))
+    return sorted(epochs)
+
+
+def refine_epochs(
+    scores: dict[int, dict[tuple[str, str], float]], available: list[int], tolerance: float
+) -> list[int]:
+    """Epochs halfway between consecutive evaluated epochs whose scores differ by more than `tolerance`"""
+    evaluated = sorted(scores)
+    refined = []
+    for first, second in zip(evaluated[:-1], evaluated[1:]):
+        between = np.array([epoch for epoch in available if first < epoch < second])
+        keys = scores[first].keys() & scores[second].keys()
+        if len(between) == 0 or not keys:
+            continue
+        change = max(abs(scores[first][key] - scores[second][key]) for key in keys)
+        if change > tolerance:
+            refined.append(int(between[np.argmin(np.abs(between - (first + second) / 2))]))
+    return refined
+
+
+def evaluate_sweep(
+    checkpoints: Path,
+    output: Path,
+    min_epoch: int = 0,
+    max_epoch: int = 100,
+    stride: int = 10,
+    tolerance: float = 0.005,
+    hierarchy_depth: int = 1,
+    feature_size: float = 0.01,
+    max_size_group: int = 10,
+    max_x_across: int = 5,
+    seed: int = 0,
+) -> None:
+    """Evaluate the checkpoints of every model from coarse to fine epochs, refining where the ABX scores change"""
+    checkpoints, output = checkpoints.resolve(), output.resolve()
+    assert stride >= 1 and hierarchy_depth >= 1
+    output.mkdir(parents=True, exist_ok=True)
+    trajectory = output / "trajectory.csv"
+    written = set()
+    if trajectory.is_file():
+        previous = pd.read_csv(trajectory)
+        written = set(zip(previous["model"], previous["epoch"]))
+
+    models = sorted({path.parent for path in checkpoints.rglob("checkpoint_*.pt")})
+    indices: dict[str, tuple[np.ndarray, TokenIndex]] = {}
+    for model in models:
+        available = checkpoint_epochs(model, min_epoch, max_epoch)
+        if not available:
+            continue
+        scores: dict[int, dict[tuple[str, str], float]] = {}
+        to_evaluate = sorted({epoch for epoch in available if (epoch - available[0]) % stride == 0} | {available[-1]})
+        while to_evaluate:
+            for epoch in to_evaluate:
+                checkpoint = model / f"checkpoint_{epoch}.pt"
+                relative = get_last_parts(checkpoint, hierarchy_depth).with_suffix("")
+                outputs = {test: output / test / relative for test in CPC.test_items}
+                scores[epoch] = checkpoint_scores(
+                    checkpoint, outputs, indices, feature_size, max_size_group, max_x_across, seed
+                )
+                if (str(model), epoch) not in written:
+                    rows = [(str(model), epoch, test, mode, score) for (test, mode), score in scores[epoch].items()]
+                    pd.DataFrame(rows, columns=["model", "epoch", "test", "mode", "score"]).to_csv(
+                        trajectory, mode="a", header=not trajectory.is_file(), index=False
+                    )
+                    written.add((str(model), epoch))
+            to_evaluate = refine_epochs(scores, available, tolerance)
@@ -0,0 +1,196 @@
+"""Vectorized slicing of the tokens of an .item file from pre-computed features"""
+import contextlib
+import dataclasses
+import hashlib
+import os
+import tempfile
+import zipfile
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from plearning.store import FeatureStore, load_pt_features
+from plearning.utils import read_item
+
+INDEX_SUFFIX = ".tokens"
+
+
+@dataclasses.dataclass
+class TokenIndex:
+    """Frame range of every token of an .item file, with integer-coded labels"""
+
+    files: np.ndarray
+    file_index: np.ndarray
+    start: np.ndarray
+    lengths: np.ndarray
+    rows: np.ndarray
+    phone: np.ndarray
+    context: np.ndarray
+    speaker: np.ndarray
+    phones: np.ndarray
+    contexts: np.ndarray
+    speakers: np.ndarray
+
+    def save(self, path: Path) -> None:
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp.npz", delete=False) as file:
+            try:
+                np.savez(file, **dataclasses.asdict(self))
+            except BaseException:
+                os.unlink(file.name)
+                raise
+        os.replace(file.name, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "TokenIndex":
+        with np.load(path) as index:
+            return cls(**{field.name: index[field.name] for field in dataclasses.fields(cls)})
+
+
+@dataclasses.dataclass
+class Tokens:
+    """Frames of every token of an .item file, stored contiguously"""
+
+    frames: np.ndarray
+    offsets: np.ndarray
+    lengths: np.ndarray
+    phone: np.ndarray
+    context: np.ndarray
+    speaker: np.ndarray
+    phone_match: dict[str, int]
+    context_match: dict[str, int]
+    speaker_match: dict[str, int]
+    rows: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def means(self) -> np.ndarray:
+        """Average frame of each token"""
+        return np.add.reduceat(self.frames, self.offsets, axis=0) / self.lengths[:, None]
+
+
+def _normalize(frames: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(frames, axis=1, keepdims=True)
+    return frames / np.where(norm == 0, 1, norm)
+
+
+def file_lengths(features: Mapping[str, np.ndarray], files: np.ndarray) -> np.ndarray:
+    """Number of frames of each file"""
+    if isinstance(features, FeatureStore):
+        return features.lengths[features.rows(files)].astype(np.int64)
+    return np.array([len(features[file]) for file in files], dtype=np.int64)
+
+
+def index_tokens(item: pd.DataFrame, lengths: np.ndarray, files: np.ndarray, feature_size: float) -> TokenIndex:
+    """Frame range of every token, following the rounding of CPC3, dropping tokens without frames"""
+    file = pd.Index(files).get_indexer(item["seg_id"])
+    missing = item["seg_id"][file < 0]
+    assert len(missing) == 0, f"No features for {missing.nunique()} files of the item, such as {missing.iloc[0]}"
+    step = 1 / feature_size
+    start = np.maximum(0, np.ceil(step * item["start"].to_numpy() - 0.5)).astype(np.int64)
+    end = np.minimum(lengths[file], np.floor(step * item["end"].to_numpy() - 0.5)).astype(np.int64)
+    rows = np.flatnonzero((start < lengths[file]) & (end > start))
+    kept = item.iloc[rows]
+
+    phone, phones = pd.factorize(kept["#phone"], sort=True)
+    context, contexts = pd.factorize(kept["prev-phone"].astype(str) + " " + kept["next-phone"].astype(str))
+    speaker, speakers = pd.factorize(kept["speaker_id"])
+    return TokenIndex(
+        files=np.asarray(files, dtype=str),
+        file_index=file[rows].astype(np.int64),
+        start=start[rows],
+        lengths=(end - start)[rows],
+        rows=rows.astype(np.int64),
+        phone=phone.astype(np.int64),
+        context=context.astype(np.int64),
+        speaker=speaker.astype(np.int64),
+        phones=np.asarray(phones, dtype=str),
+        contexts=np.asarray(contexts, dtype=str),
+        speakers=np.asarray(speakers, dtype=str),
+    )
+
+
+def slice_tokens(index: TokenIndex, features: Mapping[str, np.ndarray], normalize: bool = True) -> Tokens:
+    """Gather the frames of every token with a single fancy indexing operation"""
+    data: np.ndarray
+    if isinstance(features, FeatureStore):
+        data, file_offsets = features.data, features.offsets[features.rows(index.files)].astype(np.int64)
+    else:
+        used = np.unique(index.file_index)
+        arrays = [np.asarray(features[file]) for file in index.files[used]]
+        file_offsets = np.zeros(len(index.files), dtype=np.int64)
+        file_offsets[used] = np.concatenate([[0], np.cumsum([len(array) for array in arrays])[:-1]])
+        data = np.concatenate(arrays)
+
+    offsets = np.concatenate([[0], np.cumsum(index.lengths)[:-1]]).astype(np.int64)
+    first = file_offsets[index.file_index] + index.start
+    positions = np.repeat(first - offsets, index.lengths) + np.arange(int(index.lengths.sum()))
+    frames = np.asarray(data[positions], dtype=np.float32)
+    return Tokens(
+        frames=_normalize(frames) if normalize else frames,
+        offsets=offsets,
+        lengths=index.lengths,
+        phone=index.phone,
+        context=index.context,
+        speaker=index.speaker,
+        phone_match={str(phone): code for code, phone in enumerate(index.phones)},
+        context_match={str(context): code for code, context in enumerate(index.contexts)},
+        speaker_match={str(speaker): code for code, speaker in enumerate(index.speakers)},
+        rows=index.rows,
+    )
+
+
+def build_tokens(
+    item: pd.DataFrame, features: Mapping[str, np.ndarray], feature_size: float, normalize: bool = True
+) -> Tokens:
+    """Slice every token of the item file from the features of its file"""
+    files = item["seg_id"].unique()
+    index = index_tokens(item, file_lengths(features, files), files, feature_size)
+    return slice_tokens(index, features, normalize)
+
+
+def _index_path(item: Path, feature_size: float, files: np.ndarray, lengths: np.ndarray) -> Path:
+    stat = item.stat()
+    digest = hashlib.sha1(f"{stat.st_mtime_ns} {stat.st_size} {feature_size}".encode())
+    digest.update("\n".join(files).encode())
+    digest.update(lengths.tobytes())
+    return item.with_name(item.name + INDEX_SUFFIX) / f"{digest.hexdigest()[:16]}.npz"
+
+
+def load_tokens(
+    item: Path, features: Path, feature_size: float = 0.01, normalize: bool = True, cache: bool = True
+) -> Tokens:
+    """Tokens of an .item file from a feature store or directory, reusing the cached index of previous runs"""
+    item_df: Optional[pd.DataFrame] = None
+    mapping: Mapping[str, np.ndarray]
+    with contextlib.ExitStack() as stack:
+        if FeatureStore.is_store(features):
+            mapping = stack.enter_context(FeatureStore(features))
+            files = np.array(list(mapping), dtype=str)
+        else:
+            item_df = read_item(item)
+            files = np.asarray(item_df["seg_id"].unique(), dtype=str)
+            mapping = load_pt_features(features, list(files))
+        lengths = file_lengths(mapping, files)
+
+        path = _index_path(item, feature_size, files, lengths)
+        if cache and path.is_file():
+            try:
+                return slice_tokens(TokenIndex.load(path), mapping, normalize)
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                path.unlink(missing_ok=True)  # Corrupt index, rebuilt below
+        item_df = read_item(item) if item_df is None else item_df
+        missing = set(item_df["seg_id"]) - set(files)
+        if missing:
+            raise FileNotFoundError(f"{len(missing)} files not found in {features}")
+        index = index_tokens(item_df, lengths, files, feature_size)
+        if cache:
+            try:
+                path.parent.mkdir(exist_ok=True)
+                index.save(path)
+            except OSError:
+                pass
+        return slice_tokens(index, mapping, normalize)
@@ -7,7 +7,7 @@ from pathlib import Path
 from typing import Optional
 
 from plearning import CPC
-from plearning.data.partition import GroupbyKey
+from plearning.keys import GroupbyKey
 
 
 class GPUQoS(StrEnum):
@@ -61,7 +61,11 @@ def launch_training(
         raise ValueError("SCRATCH not in environment variables")
     db_path = Path(dataset) / "train"
     db_path /= "full" if full else f"{groupby_key}/{split}/{idx}"
-    assert (CPC.data / db_path).is_dir()
+    path_db, manifest = CPC.data / db_path, CPC.data / db_path.with_suffix(".txt")
+    if not path_db.is_dir() and manifest.is_file():
+        # Partition created in manifest mode: train on the listed segments of the full set
+        path_db = CPC.data / dataset / "train/full"
+    assert path_db.is_dir()
 
     chk_path = f"{template.stem.strip('_nodistributed')}" + f"-{str(db_path).replace('/', '_')}"
     start_time = datetime.now().strftime("%b%d_%H_%M_%S")
@@ -81,8 +85,10 @@ def launch_training(
         assert chk_to_retrain_new_dataset.is_file()
         destination /= chk_to_retrain_new_dataset.parent.name
         if not destination.is_dir():
-            move_train_directory(chk_to_retrain_new_dataset, destination, CPC.data / db_path)
-    cmd += [str(template), str(CPC.data / db_path), str(destination), str(max_epochs)]
+            move_train_directory(chk_to_retrain_new_dataset, destination, path_db)
+    cmd += [str(template), str(path_db), str(destination), str(max_epochs)]
+    if path_db != CPC.data / db_path:
+        cmd.append(str(manifest))
 
     if not (destination / f"checkpoint_{max_epochs-1}.pt").exists():
         print(" ".join(cmd))
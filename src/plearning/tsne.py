@@ -1,12 +1,113 @@
-from collections import namedtuple
+import time
+import tracemalloc
 from pathlib import Path
 from typing import Optional
 
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 
-from plearning import CPC
+from plearning.features import extract_features, load_feature_function
+from plearning.tokens import build_tokens
+from plearning.utils import get_logger, read_item
+
+DEFAULT_PAIRS = ["rl", "wy"]
+
+
+def stratified_sample(
+    phone_infos: pd.DataFrame, max_tokens: Optional[int], by: list[str], seed: int = 0
+) -> np.ndarray:
+    """Positions of at most `max_tokens` rows, with the same cap on every group so that small groups are kept whole"""
+    if max_tokens is None or len(phone_infos) <= max_tokens:
+        return np.arange(len(phone_infos))
+    codes = phone_infos.groupby(by, sort=False, dropna=False).ngroup().to_numpy()
+    sizes = np.sort(np.bincount(codes))
+    kept = np.cumsum(sizes) + sizes * np.arange(len(sizes) - 1, -1, -1)
+    full_groups = np.searchsorted(kept, max_tokens, side="right")
+    cap = sizes[full_groups - 1] if full_groups > 0 else 0
+    if full_groups < len(sizes):
+        remaining = max_tokens - (sizes[:full_groups].sum() if full_groups > 0 else 0)
+        cap = max(cap, remaining // (len(sizes) - full_groups))
+
+    order = np.random.default_rng(seed).permutation(len(codes))
+    rank = pd.Series(codes[order]).groupby(codes[order]).cumcount().to_numpy()
+    return np.sort(order[rank < cap])
+
+
+def _pair_phones(pair: str) -> list[str]:
+    return [phone.upper() for phone in (pair.split("-") if "-" in pair else pair)]
+
+
+def _embed(
+    output: Path,
+    name: str,
+    indices: np.ndarray,
+    pca_components: int,
+    perplexity: float,
+    seed: int,
+) -> dict[str, float | int | str]:
+    start = time.perf_counter()
+    # Peak of the allocations of this run only, as the RSS of a reused worker keeps the peak of earlier runs
+    tracemalloc.start()
+    try:
+        data = np.load(output / "data.npy", mmap_mode="r")[indices].astype(np.float32)
+        dimension = data.shape[1]
+        if 0 < pca_components < min(data.shape):
+            data = PCA(n_components=pca_components, random_state=seed).fit_transform(data)
+        perplexity = min(perplexity, (len(data) - 1) / 3)
+        embedded = TSNE(perplexity=perplexity, random_state=seed).fit_transform(data)
+        np.save(output / f"{name}.npy", embedded)
+        np.save(output / f"{name}_idx.npy", indices)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "name": name,
+        "tokens": len(indices),
+        "dimension": dimension,
+        "reduced_dimension": data.shape[1],
+        "seconds": time.perf_counter() - start,
+        "peak_memory_mb": peak / 2**20,
+    }
+
+
+def embed_tsne(
+    output: Path,
+    pairs: list[str] = DEFAULT_PAIRS,
+    full: bool = True,
+    max_tokens: Optional[int] = None,
+    pca_components: int = 0,
+    perplexity: float = 30.0,
+    seed: int = 0,
+    n_jobs: int = -1,
+) -> None:
+    """t-SNE representations of the features saved in `output`, on all phones and on each pair, one run per worker"""
+    logger = get_logger("tsne")
+    phone_infos = pd.read_csv(output / "phone_infos.csv")
+    runs = {}
+    if full:
+        runs["tsne"] = stratified_sample(phone_infos, max_tokens, ["phone", "speaker"], seed)
+    for pair in pairs:
+        positions = np.flatnonzero(phone_infos["phone"].isin(_pair_phones(pair)))
+        sample = stratified_sample(phone_infos.iloc[positions], max_tokens, ["phone", "speaker"], seed)
+        runs[f"tsne_{pair.lower()}"] = positions[sample]
+    for name, indices in list(runs.items()):
+        if len(indices) < 2:
+            logger.error(f"Not enough tokens for {name}: {len(indices)}")
+            del runs[name]
+
+    launcher = Parallel(n_jobs=n_jobs, verbose=10)
+    reports = launcher(
+        delayed(_embed)(output, name, indices, pca_components, perplexity, seed) for name, indices in runs.items()
+    )
+    for report in reports:
+        logger.info(
+            f"{report['name']}: {report['tokens']} tokens, {report['dimension']} -> {report['reduced_dimension']} "
+            f"dimensions, {report['seconds']:.1f}s, peak memory {report['peak_memory_mb']:.0f} MB"
+        )
+    pd.DataFrame(reports).to_csv(output / "tsne_report.csv", index=False)
 
 
 def build_tsne(
@@ -20,64 +121,28 @@ def build_tsne(
     perplexity: float = 30.0,
     seed: int = 0,
     is_untrained: bool = False,
+    pairs: list[str] = DEFAULT_PAIRS,
+    max_tokens: Optional[int] = None,
+    pca_components: int = 0,
+    n_jobs: int = -1,
 ) -> None:
     """Compute output features and their t-SNE representations of a given model and test set"""
-    try:
-        import torch
-    except ImportError as error:
-        raise ImportError("You must install pytorch to build features for t-SNE") from error
-
-    try:
-        from cpc.clustering.clustering import loadClusterModule
-        from cpc.dataset import findAllSeqs
-        from cpc.eval.ABX import abx_iterators as abx_it
-        from cpc.feature_loader import FeatureModule, buildFeature, loadModel
-    except ImportError as error:
-        raise ImportError("You must install CPC3 to build features for t-SNE") from error
-
-    model = loadModel([path_checkpoint], loadStateDict=not is_untrained)[0]
-    model.gAR.keepHidden = True
-    feature_maker = FeatureModule(model, get_encoded).cuda().eval()
-
-    def base_features(x: str) -> torch.Tensor:
-        return buildFeature(feature_maker, x, seqNorm=CPC.seq_norm, strict=CPC.strict, maxSizeSeq=CPC.max_size_seq)
-
-    if from_centroid is not None:
-        cluster_module = loadClusterModule(from_centroid)
-
-        def feature_function(x: str) -> torch.Tensor:
-            c_feature = base_features(x)
-            dist_clusters = cluster_module(c_feature)
-            q_feature = torch.argmin(dist_clusters, dim=-1)
-            return cluster_module.Ck[:, q_feature.squeeze()]
-
-    else:
-        feature_function = base_features
-
-    seq_list, _ = findAllSeqs(path_dataset, extension=CPC.file_extension)
-    seq_list = [(str(Path(x).stem), str(Path(path_dataset) / x)) for (_, x) in seq_list]
+    feature_function = load_feature_function(path_checkpoint, get_encoded, from_centroid, is_untrained)
+    item = read_item(path_item_file)
+    features = extract_features(feature_function, item, path_dataset)
 
     output.mkdir(exist_ok=True)
-    dataset = abx_it.ABXFeatureLoader(path_item_file, seq_list, feature_function, 1 / feature_size, normalize=True)
-    context_match = {v: k for k, v in dataset.context_match.items()}
-    phone_match = {v: k for k, v in dataset.phone_match.items()}
-    speaker_match = {v: k for k, v in dataset.speaker_match.items()}
-    full_data, df = [], []
-
-    PhoneInfos = namedtuple("PhoneInfos", ["idx", "context", "phone", "speaker"])
-    for idx, (sample_data, _, (context_id, phone_id, speaker_id)) in enumerate(dataset):
-        full_data.append(sample_data.mean(axis=0))
-        df.append(PhoneInfos(idx, context_match[context_id], phone_match[phone_id], speaker_match[speaker_id]))
-    data = torch.stack(full_data).numpy()
-    phone_infos = pd.DataFrame(df)
+    tokens = build_tokens(item, features, feature_size)
+    data = tokens.means()
+    phone_infos = pd.DataFrame(
+        {
+            "idx": np.arange(len(tokens)),
+            "context": np.array(list(tokens.context_match))[tokens.context],
+            "phone": np.array(list(tokens.phone_match))[tokens.phone],
+            "speaker": np.array(list(tokens.speaker_match))[tokens.speaker],
+        }
+    )
 
     np.save(output / "data.npy", data)
     phone_infos.to_csv(output / "phone_infos.csv", index=False)
-
-    data_embedded = TSNE(perplexity=perplexity, verbose=10, random_state=seed).fit_transform(data)
-    np.save(output / "tsne.npy", data_embedded)
-
-    for phone_pair in ["rl", "wy"]:
-        data_pair = data[data.phone.isin([*phone_pair.upper()])]
-        data_embedded = TSNE(perplexity=perplexity, verbose=10, random_state=seed).fit_transform(data_pair)
-        np.save(output / f"tsne_{phone_pair}.npy", data_embedded)
+    embed_tsne(output, pairs, True, max_tokens, pca_components, perplexity, seed, n_jobs)
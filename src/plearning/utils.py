@@ -1,14 +1,16 @@
 import logging
+import os
+import tempfile
 from pathlib import Path
 from typing import Any
 
 import numpy as np
 import pandas as pd
 
+from plearning import CPC
+from plearning.datasets import DatasetKind
 from plearning.phone_pair import PhonePair
 
-DATASETS_LANG = {"csj": "Japanese", "gpj": "Japanese", "wsj": "English", "buc": "English"}
-
 
 def get_logger(
     name: str, *, filename: Path | None = None, formatter: str = "%(asctime)s - %(levelname)s - %(message)s"
@@ -40,9 +42,10 @@ def native_nonnative_selection(
     df: pd.DataFrame, datasets: list[str], **kwargs: Any
 ) -> tuple[pd.DataFrame, pd.DataFrame]:
     native_idx, non_native_idx = None, None
+    languages = [CPC.datasets.language(train) for train in CPC.datasets.names(DatasetKind.TRAIN)]
     for test in datasets:
-        this_test = (df["test"] == test) & (df["train"].isin(["English", "Japanese"]))
-        is_native = df.train == DATASETS_LANG[test]
+        this_test = (df["test"] == test) & (df["train"].isin(languages))
+        is_native = df.train == CPC.datasets.language(test)
         if native_idx is None:
             native_idx = this_test & is_native
             non_native_idx = this_test & (~is_native)
@@ -83,19 +86,71 @@ def make_pairwise_score(score: pd.DataFrame, col: str) -> pd.DataFrame:
     return pd.concat(subdfs, ignore_index=True)
 
 
-def read_item(filepath_or_buffer: str | Path) -> pd.DataFrame:
-    """Read an .item file into a pandas DataFrame"""
-    item_file = pd.read_csv(filepath_or_buffer, sep=" ")
-    item_file.rename(
-        {
-            "#file": "seg_id",
-            "speaker": "speaker_id",
-            "onset": "start",
-            "offset": "end",
-        },
-        axis=1,
-        inplace=True,
-    )
+ITEM_COLUMNS = {"#file": "seg_id", "onset": "start", "offset": "end", "speaker": "speaker_id"}
+ITEM_DTYPES = {
+    "#file": "category",
+    "onset": "float64",
+    "offset": "float64",
+    "#phone": "category",
+    "prev-phone": "category",
+    "next-phone": "category",
+    "speaker": "category",
+}
+ITEM_SIDECAR_SUFFIX = ".feather"
+
+
+def _item_stamp(path: Path) -> bytes:
+    stat = path.stat()
+    return f"{stat.st_mtime_ns} {stat.st_size}".encode()
+
+
+def _read_item_sidecar(path: Path) -> pd.DataFrame | None:
+    import pyarrow
+    import pyarrow.feather
+
+    sidecar = path.with_name(path.name + ITEM_SIDECAR_SUFFIX)
+    if not sidecar.is_file():
+        return None
+    try:
+        table = pyarrow.feather.read_table(sidecar, memory_map=True)
+    except (OSError, pyarrow.ArrowInvalid):
+        sidecar.unlink(missing_ok=True)
+        return None
+    if (table.schema.metadata or {}).get(b"item_stamp") != _item_stamp(path):
+        return None
+    return table.to_pandas()
+
+
+def _write_item_sidecar(path: Path, item: pd.DataFrame) -> None:
+    import pyarrow
+    import pyarrow.feather
+
+    table = pyarrow.Table.from_pandas(item, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"item_stamp": _item_stamp(path)})
+    sidecar = path.with_name(path.name + ITEM_SIDECAR_SUFFIX)
+    try:
+        fd, tmp = tempfile.mkstemp(dir=sidecar.parent, suffix=".tmp")
+    except OSError:
+        return
+    os.close(fd)
+    try:
+        pyarrow.feather.write_feather(table, tmp, compression="uncompressed")
+        os.replace(tmp, sidecar)
+    except OSError:
+        Path(tmp).unlink(missing_ok=True)
+
+
+def read_item(filepath_or_buffer: str | Path, cache: bool = True) -> pd.DataFrame:
+    """Read an .item file into a pandas DataFrame, from its memory-mapped binary sidecar if it is up to date"""
+    path = Path(filepath_or_buffer) if isinstance(filepath_or_buffer, (str, Path)) else None
+    if cache and path is not None:
+        item_file = _read_item_sidecar(path)
+        if item_file is not None:
+            return item_file
+    item_file = pd.read_csv(filepath_or_buffer, sep=" ", dtype=ITEM_DTYPES)
+    item_file.rename(ITEM_COLUMNS, axis=1, inplace=True)
+    if cache and path is not None:
+        _write_item_sidecar(path, item_file)
     return item_file
 
 
@@ -0,0 +1,147 @@
+"""Parallel discovery of files in large directory trees, with a persistent index keyed by directory mtimes"""
+import dataclasses
+import fnmatch
+import hashlib
+import os
+import pickle
+import tempfile
+from pathlib import Path
+from typing import Iterable, Optional
+
+from joblib import Parallel, delayed
+
+from plearning import CPC
+
+
+@dataclasses.dataclass
+class Listing:
+    mtime: int
+    subdirs: list[str]
+    files: list[str]
+
+
+Identity = tuple[int, int]
+
+# Directory names never holding results: the logs of `plearning run` and hidden directories such as temporary copies
+RESULT_PRUNE = ["*_logs", ".*"]
+
+
+def _list_directory(
+    directory: str, cached: Optional[Listing], follow_symlinks: bool
+) -> Optional[tuple[Identity, Listing]]:
+    try:
+        stat = os.stat(directory)
+        identity = (stat.st_dev, stat.st_ino)
+        if cached is not None and cached.mtime == stat.st_mtime_ns:
+            return identity, cached
+        subdirs: list[str] = []
+        files: list[str] = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    subdirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return None
+    return identity, Listing(stat.st_mtime_ns, sorted(subdirs), sorted(files))
+
+
+def _list_batch(
+    directories: list[str], index: dict[str, Listing], follow_symlinks: bool
+) -> list[Optional[tuple[Identity, Listing]]]:
+    return [_list_directory(directory, index.get(directory), follow_symlinks) for directory in directories]
+
+
+def _load_index(index: Path, follow_symlinks: bool) -> dict[str, Listing]:
+    try:
+        with open(index, "rb") as file:
+            stored = pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+    if not isinstance(stored, dict) or stored.get("follow_symlinks") != follow_symlinks:
+        return {}
+    return stored["tree"]
+
+
+def _save_index(index: Path, tree: dict[str, Listing], follow_symlinks: bool) -> None:
+    index.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=index.parent, suffix=".tmp", delete=False) as file:
+        try:
+            pickle.dump({"follow_symlinks": follow_symlinks, "tree": tree}, file, protocol=pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            os.unlink(file.name)
+            raise
+    os.replace(file.name, index)
+
+
+def index_path(root: Path) -> Path:
+    """Default location of the index of a directory tree"""
+    return CPC.cache / "walk" / f"{hashlib.sha1(str(root).encode()).hexdigest()[:16]}.pkl"
+
+
+def walk(
+    root: Path,
+    prune: Iterable[str] = (),
+    n_jobs: int = -1,
+    index: Optional[Path] = None,
+    follow_symlinks: bool = False,
+) -> dict[str, Listing]:
+    """Listing of every directory under `root` not pruned, only re-listing directories whose mtime changed
+
+    Every directory is still stat-ed on each run: the mtime of a directory only changes with its own entries, so an
+    unchanged directory can hold a changed subtree. The index saves the scandir of unchanged directories. Symbolic
+    links to directories are followed with `follow_symlinks`: a directory reached through several links is listed under
+    each path, as `rglob` does, but a link to one of its own ancestors is not followed.
+    """
+    root = root.resolve()
+    prune = list(prune)
+    previous = _load_index(index, follow_symlinks) if index is not None and index.is_file() else {}
+
+    tree: dict[str, Listing] = {}
+    ancestors: dict[str, frozenset[Identity]] = {str(root): frozenset()}
+    level = [str(root)]
+    with Parallel(n_jobs=n_jobs, prefer="threads") as launcher:
+        while level:
+            size = max(1, min(256, len(level) // (4 * (os.cpu_count() or 1))))
+            batches = [level[i : i + size] for i in range(0, len(level), size)]
+            results = launcher(delayed(_list_batch)(batch, previous, follow_symlinks) for batch in batches)
+            next_level: list[str] = []
+            next_ancestors: dict[str, frozenset[Identity]] = {}
+            for batch, listings in zip(batches, results):
+                for directory, result in zip(batch, listings):
+                    if result is None or result[0] in ancestors[directory]:
+                        continue
+                    identity, listing = result
+                    tree[directory] = listing
+                    chain = ancestors[directory] | {identity}
+                    for name in listing.subdirs:
+                        if not any(fnmatch.fnmatch(name, pattern) for pattern in prune):
+                            next_level.append(os.path.join(directory, name))
+                            next_ancestors[next_level[-1]] = chain
+            level, ancestors = next_level, next_ancestors
+
+    if index is not None and tree != previous:
+        _save_index(index, tree, follow_symlinks)
+    return tree
+
+
+def find_files(
+    root: Path, pattern: str, prune: Iterable[str] = (), n_jobs: int = -1, use_index: bool = True
+) -> list[Path]:
+    """Sorted paths of the files under `root` whose name matches `pattern`"""
+    root = root.resolve()
+    try:
+        index = index_path(root) if use_index else None
+    except KeyError:
+        index = None
+    tree = walk(root, prune, n_jobs, index)
+    return sorted(
+        Path(directory) / name
+        for directory, listing in tree.items()
+        for name in fnmatch.filter(listing.files, pattern)
+    )
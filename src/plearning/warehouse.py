@@ -0,0 +1,242 @@
+"""Local SQLite warehouse of ABX scores, ingested incrementally from result directories or score tables"""
+import math
+import sqlite3
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Optional
+
+import pandas as pd
+import typer
+from joblib import Parallel, delayed
+
+from plearning import CPC
+from plearning.phone_pair import PhonePair
+from plearning.scores import load_scores, read_result, result_stamp
+from plearning.walk import RESULT_PRUNE, find_files
+
+RESULT_COLUMNS = ["test", "train", "split", "idx", "mode", "epoch"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL UNIQUE,
+    stamp TEXT NOT NULL,
+    setup TEXT NOT NULL,
+    test TEXT NOT NULL,
+    train TEXT NOT NULL,
+    split INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    epoch INTEGER
+);
+CREATE TABLE IF NOT EXISTS scores (
+    result_id INTEGER NOT NULL REFERENCES results(id) ON DELETE CASCADE,
+    phone_pair TEXT,
+    score REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS condition_stats (
+    setup TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    phone_pair TEXT,
+    test TEXT NOT NULL,
+    train TEXT NOT NULL,
+    split INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    mean REAL NOT NULL,
+    std REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_condition ON results(setup, mode, test, train, split);
+CREATE INDEX IF NOT EXISTS scores_result ON scores(result_id);
+CREATE INDEX IF NOT EXISTS scores_phone_pair ON scores(phone_pair, result_id);
+CREATE INDEX IF NOT EXISTS condition_stats_selection ON condition_stats(mode, phone_pair, setup);
+"""
+
+# Population standard deviation (ddof=0), exactly 0 for a single model
+AGGREGATE = """
+INSERT INTO condition_stats
+SELECT r.setup, r.mode, s.phone_pair, r.test, r.train, r.split, COUNT(*), AVG(s.score),
+    CASE WHEN COUNT(*) = 1 THEN 0.0
+    ELSE sqrt(MAX(AVG(s.score * s.score) - AVG(s.score) * AVG(s.score), 0.0)) END
+FROM results r JOIN scores s ON s.result_id = r.id
+WHERE r.setup = ?
+GROUP BY r.setup, r.mode, s.phone_pair, r.test, r.train, r.split
+"""
+
+
+class Warehouse:
+    """Scores of every result, keyed by their source, with mean and std per condition kept up to date"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        try:
+            self.connection.execute("SELECT sqrt(1.0)")
+        except sqlite3.OperationalError:
+            self.connection.create_function("sqrt", 1, math.sqrt, deterministic=True)
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self) -> "Warehouse":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_val: Optional[BaseException],
+        exc_tb: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def stamps(self, prefix: str) -> dict[str, str]:
+        """Stamp of every source starting with `prefix`"""
+        rows = self.connection.execute(
+            "SELECT source, stamp FROM results WHERE substr(source, 1, ?) = ?", (len(prefix), prefix)
+        )
+        return dict(rows.fetchall())
+
+    def replace(self, setup: str, removed: list[str], scores: pd.DataFrame) -> None:
+        """Delete the `removed` sources, insert the scores of each source, then refresh the statistics of the setup
+
+        `scores` has one row per score, with the source, its stamp, the result columns, the phone pair and the score.
+        """
+        with self.connection:
+            for start in range(0, len(removed), 500):
+                batch = removed[start : start + 500]
+                self.connection.execute(f"DELETE FROM results WHERE source IN ({', '.join('?' * len(batch))})", batch)
+            if len(scores) > 0:
+                (first_id,) = self.connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM results").fetchone()
+                result_id = first_id + scores.groupby("source", sort=False).ngroup().to_numpy()
+                results = scores.assign(id=result_id).drop_duplicates("source")
+                self.connection.executemany(
+                    "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        (
+                            int(row.id),
+                            row.source,
+                            row.stamp,
+                            setup,
+                            row.test,
+                            row.train,
+                            int(row.split),
+                            int(row.idx),
+                            row.mode,
+                            None if pd.isna(row.epoch) else int(row.epoch),
+                        )
+                        for row in results.itertuples(index=False)
+                    ),
+                )
+                self.connection.executemany(
+                    "INSERT INTO scores VALUES (?, ?, ?)",
+                    zip(
+                        result_id.tolist(),
+                        scores["phone_pair"].astype(object).where(scores["phone_pair"].notna(), None).tolist(),
+                        scores["score"].astype(float).tolist(),
+                    ),
+                )
+            if removed or len(scores) > 0:
+                self.connection.execute("DELETE FROM condition_stats WHERE setup = ?", (setup,))
+                self.connection.execute(AGGREGATE, (setup,))
+
+    def import_table(self, table: Path, setup: str) -> int:
+        """Replace the scores of a table written by `plearning scores` if it changed, returning how many were read"""
+        table = table.resolve()
+        stat = table.stat()
+        stamp = f"{stat.st_mtime_ns} {stat.st_size}"
+        stamps = self.stamps(f"{table}::")
+        if stamps and all(previous == stamp for previous in stamps.values()):
+            return 0
+        scores = load_scores(table)
+        if "epoch" not in scores.columns:
+            scores["epoch"] = None
+        source = pd.Series(f"{table}::", index=scores.index)
+        for column in RESULT_COLUMNS:
+            source += "/" + scores[column].astype(str).fillna("")
+        scores.insert(0, "source", source)
+        scores.insert(1, "stamp", stamp)
+        self.replace(setup, list(stamps), scores)
+        return len(scores)
+
+    def phone_pairs(self, phone_pair: Any) -> list[str]:
+        """Stored phone pairs equal to `phone_pair`, which can be a string or a PhonePair"""
+        stored = [pair for (pair,) in self.connection.execute("SELECT DISTINCT phone_pair FROM condition_stats")]
+        return [pair for pair in stored if pair is not None and phone_pair == pair]
+
+    def _where(self, setups: Optional[list[str]], mode: Optional[str], phone_pair: Any) -> tuple[str, list]:
+        conditions, parameters = [], []
+        if setups is not None:
+            conditions.append(f"setup IN ({', '.join('?' * len(setups))})")
+            parameters.extend(setups)
+        if mode is not None:
+            conditions.append("mode = ?")
+            parameters.append(mode)
+        if phone_pair is None or (isinstance(phone_pair, PhonePair) and phone_pair.first is None):
+            conditions.append("phone_pair IS NULL")
+        else:
+            pairs = self.phone_pairs(phone_pair)
+            conditions.append(f"phone_pair IN ({', '.join('?' * len(pairs))})")
+            parameters.extend(pairs)
+        return " AND ".join(conditions), parameters
+
+    def stats(
+        self, mode: Optional[str] = None, phone_pair: Any = None, setups: Optional[list[str]] = None
+    ) -> pd.DataFrame:
+        """Mean and std of the scores of each setup, test, train and split, on all pairs or on one phone pair"""
+        where, parameters = self._where(setups, mode, phone_pair)
+        query = f"SELECT * FROM condition_stats WHERE {where} ORDER BY setup, test, train, split"
+        return pd.read_sql_query(query, self.connection, params=parameters)
+
+    def scores(
+        self, mode: Optional[str] = None, phone_pair: Any = None, setups: Optional[list[str]] = None
+    ) -> pd.DataFrame:
+        """Scores of every result, on all pairs or on one phone pair"""
+        where, parameters = self._where(setups, mode, phone_pair)
+        query = (
+            "SELECT r.setup, r.test, r.train, s.phone_pair, r.split, r.idx, r.mode, r.epoch, s.score "
+            f"FROM results r JOIN scores s ON s.result_id = r.id WHERE {where}"
+        )
+        return pd.read_sql_query(query, self.connection, params=parameters)
+
+
+def ingest_results(
+    results: Path,
+    database: Path,
+    setup: str,
+    train_parent: int = 0,
+    n_jobs: int = -1,
+    prune: list[str] = typer.Option(RESULT_PRUNE, "--prune", help="Pattern of directory names not to descend into"),
+) -> None:
+    """Add the result directories of a setup to the warehouse, only reading the ones that changed"""
+    results = results.resolve()
+    items = {str(item): test for test, item in CPC.test_items.items()}
+    directories = {str(path.parent): path.parent for path in find_files(results, "ABX_args.json", prune, n_jobs)}
+    current = {directory: repr(result_stamp(path)) for directory, path in directories.items()}
+
+    with Warehouse(database) as warehouse:
+        stamps = warehouse.stamps(f"{results}/")
+        to_read = [directory for directory, stamp in current.items() if stamps.get(directory) != stamp]
+        removed = [directory for directory in stamps if directory not in current or directory in to_read]
+        launcher = Parallel(n_jobs=n_jobs, verbose=10)
+        frames = launcher(delayed(read_result)(directories[d], items, train_parent) for d in to_read)
+        for directory, df in zip(to_read, frames):
+            df.insert(0, "source", directory)
+            df.insert(1, "stamp", current[directory])
+        scores = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        warehouse.replace(setup, removed, scores)
+    print(f"{len(to_read)} results read, {len(current) - len(to_read)} unchanged, {len(removed)} replaced or removed")
+
+
+def import_scores(table: Path, database: Path, setup: str) -> None:
+    """Add a table of scores written by `plearning scores` to the warehouse, replacing it if it changed"""
+    with Warehouse(database) as warehouse:
+        count = warehouse.import_table(table, setup)
+    print(f"{count} scores imported from {table}" if count else f"{table} is unchanged")
+
+
+def print_stats(database: Path, mode: str = "within", phone_pair: Optional[str] = None) -> None:
+    """Print the mean and std of the scores of each condition, on all pairs or on one phone pair"""
+    with Warehouse(database) as warehouse:
+        print(warehouse.stats(mode, phone_pair).to_string(index=False))